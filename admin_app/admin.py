@@ -50,6 +50,14 @@ class ColorAdmin(admin.ModelAdmin):
     search_fields = ['name']
     list_per_page = 20
 
+# Converted product prices (maintained automatically)
+@admin.register(ProductPrice)
+class ProductPriceAdmin(admin.ModelAdmin):
+    list_display = ['product', 'currency', 'amount', 'rate', 'updated_at']
+    list_filter = ['currency']
+    search_fields = ['product__name']
+    list_per_page = 20
+
 # Product Admin with inline SubProducts
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
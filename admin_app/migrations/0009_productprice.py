@@ -0,0 +1,30 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_app', '0008_alter_subproduct_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=18)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='admin_app.product')),
+            ],
+            options={
+                'verbose_name_plural': 'ProductPrices',
+                'indexes': [models.Index(fields=['currency', 'amount'], name='admin_app_p_currenc_549474_idx')],
+                'unique_together': {('product', 'currency')},
+            },
+        ),
+    ]
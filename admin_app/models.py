@@ -1,6 +1,8 @@
 from django.db import models
 from django.conf import settings
 from django.templatetags.static import static
+from django.dispatch import receiver
+from django.db.models.signals import post_save
 # from app.models import User
 # Create your models here.
 import requests
@@ -30,6 +32,23 @@ class Product(models.Model):
     def __str__(self):
         return f'{self.name} - {self.price} | {self.category}'
     
+
+class ProductPrice(models.Model):
+    """Product price converted to another currency, recomputed whenever the cached exchange rate changes"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='prices')
+    currency = models.CharField(max_length=3)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    rate = models.DecimalField(max_digits=18, decimal_places=10)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'ProductPrices'
+        unique_together = ('product', 'currency')
+        indexes = [models.Index(fields=['currency', 'amount'])]
+
+    def __str__(self):
+        return f'{self.product.name} - {self.amount} {self.currency}'
+
             
 class Size(models.Model):
     name = models.CharField(max_length=50)
@@ -134,4 +153,10 @@ class SubProduct(models.Model):
             return f"{media_prefix}/{image_path.lstrip('/')}"
 
         return static('img/empty_cart.png')
-    
+
+
+@receiver(post_save, sender=Product)
+def update_product_prices(sender, instance, **kwargs):
+    # keep the converted price of a new/edited product in sync with the cached rate
+    from app.currency import refresh_product_prices
+    refresh_product_prices(products=[instance])
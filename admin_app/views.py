@@ -4,6 +4,8 @@ from django.shortcuts import get_object_or_404, render,redirect
 from django.views.decorators.csrf import csrf_exempt
 from app.models import *
 from admin_app.models import *
+from app.currency import currency_metrics as get_currency_metrics
+from app.pagination import paginate
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
@@ -625,7 +627,8 @@ def remove_product(request, id):
 
 @login_required(login_url='/admin/login/?next=/admin_side/')
 def allproduct(request):
-    products = SubProduct.objects.all().order_by('-created_at').select_related('product', 'product__category').prefetch_related('product_size_color')
+    page = paginate(SubProduct.objects.select_related('product', 'product__category').prefetch_related('product_size_color'), request)
+    products = page.items
    
     # Add stock information to each product
     for product in products:
@@ -636,6 +639,7 @@ def allproduct(request):
    
     context = {
         'products': products,
+        'page': page,
     }
     return render(request, 'all_product.html', context)
 
@@ -717,7 +721,8 @@ def product_variants(request, product_id):
 @login_required(login_url='/admin/login/?next=/admin_side/')
 def variant_list(request):
     """View to show all variants across all products"""
-    variants = SubProduct.objects.all().order_by('-created_at').select_related('product', 'product__category').prefetch_related('product_size_color')
+    page = paginate(SubProduct.objects.select_related('product', 'product__category').prefetch_related('product_size_color'), request)
+    variants = page.items
    
     # Add stock information to each variant
     for variant in variants:
@@ -728,6 +733,7 @@ def variant_list(request):
    
     context = {
         'variants': variants,
+        'page': page,
     }
     return render(request, 'variant_list.html', context)
 
@@ -744,7 +750,8 @@ def admin_logout(request):
 def user_list(request):
     """Enhanced user list with engagement metrics and purchase history"""
     try:
-        users = User.objects.all().order_by('-created_at')
+        page = paginate(User.objects.all(), request)
+        users = page.items
         
         # Enrich users with engagement and purchase data
         users_with_stats = []
@@ -813,16 +820,17 @@ def user_list(request):
                 'purchased_products_details': list(purchased_products_details),  # All purchases
             })
         
-        # Calculate summary statistics
-        total_users = len(users_with_stats)
-        users_with_purchases = sum(1 for u in users_with_stats if u['has_purchased'])
-        total_revenue = sum(u['total_spent'] for u in users_with_stats)
+        # Calculate summary statistics over every user, not just this page
+        total_users = User.objects.count()
+        users_with_purchases = User.objects.filter(placeorder__isnull=False).distinct().count()
+        total_revenue = placeOrder.objects.aggregate(total=Sum('total_amount'))['total'] or 0
         
         context = {
             'users_with_stats': users_with_stats,
             'total_users': total_users,
             'users_with_purchases': users_with_purchases,
             'total_revenue': total_revenue,
+            'page': page,
         }
         return render(request, 'user_list.html', context)
     except Exception as e:
@@ -831,24 +839,28 @@ def user_list(request):
         print(traceback.format_exc())
         messages.error(request, f'Error loading user list: {str(e)}')
         # Fallback to simple user list
-        users = User.objects.all().order_by('-created_at')
+        page = paginate(User.objects.all(), request)
+        users = page.items
         context = {
             'users_with_stats': [{'user': user, 'total_orders': 0, 'total_cart_items': 0, 'total_messages': 0, 'total_spent': 0, 'total_items_purchased': 0, 'unique_products_count': 0, 'has_purchased': False, 'product_purchase_count': {}, 'purchased_products_details': []} for user in users],
-            'total_users': users.count(),
+            'total_users': User.objects.count(),
             'users_with_purchases': 0,
             'total_revenue': 0,
+            'page': page,
         }
         return render(request, 'user_list.html', context)
 
 
 @login_required(login_url='/admin/login/?next=/admin_side/')
 def order_list(request):
-    orders = placeOrder.objects.all().order_by('-order_date')
+    orders = placeOrder.objects.all()
     
     # Filter by status if provided
     status_filter = request.GET.get('status')
     if status_filter:
         orders = orders.filter(order_status=status_filter)
+    page = paginate(orders, request, keys=('-order_date', '-id'), nullable=('order_date',))
+    orders = page.items
     
     # Get counts for filter tabs
     total_orders = placeOrder.objects.all().count()
@@ -865,17 +877,20 @@ def order_list(request):
         'delivered_count': delivered_count,
         'cancelled_count': cancelled_count,
         'returned_count': returned_count,
+        'page': page,
     }
     return render(request, 'order_list.html', context)
 
 
 @login_required(login_url='/admin/login/?next=/admin_side/')
 def contact_list(request):
-    contacts = Contact.objects.all().order_by('-created_at')
+    page = paginate(Contact.objects.all(), request)
+    contacts = page.items
     # print(contacts)
     
     context = {
         'contacts':contacts,
+        'page': page,
     }
     return render(request, 'contact_list.html', context)
 
@@ -1212,6 +1227,11 @@ def get_unread_count(request):
     unread_count = Message.objects.filter(is_seen=False).count()
     return JsonResponse({'unread_count': unread_count})
 
+@login_required(login_url='/admin/login/?next=/admin_side/')
+def currency_metrics(request):
+    """Currency API circuit breaker state and fetch latency"""
+    return JsonResponse(get_currency_metrics())
+
 @login_required(login_url='/admin/login/?next=/admin_side/')
 def order_detail(request, order_id):
     try:
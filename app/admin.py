@@ -11,6 +11,9 @@ admin.site.register(sub_placeorder)
 admin.site.register(Contact)
 admin.site.register(Message)
 admin.site.register(Review)
+admin.site.register(ExchangeRate)
+admin.site.register(StockReservation)
+admin.site.register(IdempotencyKey)
 
 admin.site.site_header = 'Baabuu Clothing Admin'
 
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # connects the page cache, search index, typeahead, product page and lookup table receivers
+        from . import page_cache, product_detail, reference, search, suggest  # noqa: F401
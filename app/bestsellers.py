@@ -0,0 +1,45 @@
+"""
+Cached bestseller ranking.
+
+The ranking (SubProduct ids, best first) is computed with one aggregate
+over the order lines of the chosen window and kept in the shared cache
+(see CACHES) for BESTSELLER_CACHE_TTL seconds, so the homepage reads it
+in constant time. The rebuild_bestsellers command (run with --loop by
+the scheduler service, or from cron) keeps it warm for every web worker.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+
+from admin_app.models import SubProduct
+from .models import sub_placeorder
+
+
+def _cache_key(days, limit):
+    return f'bestsellers:{days or "all"}:{limit}'
+
+
+def rebuild_bestsellers(days=None, limit=10):
+    """Rank the `limit` most sold SubProducts of the last `days` days (all time when None)"""
+    lines = sub_placeorder.objects.exclude(order_id__order_status__in=['Cancelled', 'Returned'])
+    if days:
+        lines = lines.filter(order_id__order_date__gte=datetime.date.today() - datetime.timedelta(days=days))
+    ids = list(lines.values('subproduct_id').annotate(sold=Sum('quantity'))
+               .order_by('-sold', 'subproduct_id').values_list('subproduct_id', flat=True)[:limit])
+
+    if len(ids) < limit:
+        # not enough sales yet, fill the grid with the newest products
+        ids += list(SubProduct.objects.exclude(id__in=ids).order_by('-created_at')
+                    .values_list('id', flat=True)[:limit - len(ids)])
+
+    cache.set(_cache_key(days, limit), ids, settings.BESTSELLER_CACHE_TTL)
+    return ids
+
+
+def bestseller_ids(days=None, limit=10):
+    ids = cache.get(_cache_key(days, limit))
+    if ids is None:
+        ids = rebuild_bestsellers(days, limit)
+    return ids
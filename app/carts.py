@@ -0,0 +1,102 @@
+"""
+Cart read path shared by the cart and checkout pages and the payment views.
+
+load_cart() fetches a user's lines with their subproduct and product in
+one query (plus, for the cart page, one prefetch of the variant rows for
+the size/color pickers). Prices are converted in memory with the cached
+exchange rate, and every total is summed in a single pass, so a cart
+costs the same number of queries whatever its length.
+"""
+from django.conf import settings
+
+from app.currency import active_currency, convert_many, is_foreign
+from . import reference
+from .models import Cart
+
+
+def shipping_charge(currency_type):
+    """Flat shipping charge in the active currency, converted from INR unless configured in SHIPPING_CHARGES"""
+    code = active_currency(currency_type)
+    if code in settings.SHIPPING_CHARGES:
+        return settings.SHIPPING_CHARGES[code]
+    return convert_many([settings.SHIPPING_CHARGES[settings.BASE_CURRENCY]], code)[0] or 0
+
+
+class CartSummary:
+    """
+    A user's cart lines and totals.
+
+    Every line gets subproduct.product.price_usd (unit price in the
+    active currency, despite the name), total_price (INR, None when a
+    foreign currency is active) and total_price_usd (active foreign
+    currency, None for INR), as the templates expect.
+
+    `unchosen` lists the lines still without a size or color (quick add
+    from the category page); they match no stock row, so checkout and the
+    payment views refuse the cart until they are chosen.
+    """
+
+    def __init__(self, lines, currency_type):
+        self.lines = lines
+        self.unchosen = [line for line in lines if not line.size or not line.color]
+        self.currency = active_currency(currency_type)
+        foreign = is_foreign(currency_type)
+        prices = [line.subproduct.product.price for line in lines]
+        display_prices = convert_many(prices, currency_type)
+        # card and PayPal payments are always charged in USD
+        usd_prices = convert_many(prices, 'USD')
+
+        self.quantity = 0
+        self.total = 0
+        self.total_display = 0
+        total_usd = 0
+        for line, price, display_price, usd_price in zip(lines, prices, display_prices, usd_prices):
+            line.subproduct.product.price_usd = display_price
+            if foreign:
+                line.total_price = None
+                line.total_price_usd = display_price * line.quantity if display_price is not None else None
+            else:
+                line.total_price = line.quantity * price
+                line.total_price_usd = None
+            line.unit_price_usd = usd_price
+            self.quantity += line.quantity
+            self.total += line.total_price or 0
+            self.total_display += line.total_price_usd or 0
+            if total_usd is not None:
+                total_usd = total_usd + usd_price * line.quantity if usd_price is not None else None
+
+        self.shipping = shipping_charge(settings.BASE_CURRENCY)
+        self.shipping_display = shipping_charge(currency_type)
+        self.grand_total = self.total + self.shipping
+        self.grand_total_display = self.total_display + self.shipping_display
+        # None while no USD rate is known: payments must not be started then
+        self.total_usd = total_usd
+        self.grand_total_usd = total_usd + shipping_charge('USD') if total_usd is not None else None
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+def load_cart(user, currency_type=None, with_options=False):
+    """
+    The user's CartSummary, newest line first. With `with_options` every
+    line also gets .sizes and .colors, the names its subproduct comes in.
+    """
+    lines = Cart.objects.filter(uname=user).select_related('subproduct__product').order_by('-created_at')
+    if with_options:
+        lines = lines.prefetch_related('subproduct__product_size_color')
+    lines = list(lines)
+
+    if with_options:
+        sizes, colors = reference.sizes(), reference.colors()
+        for line in lines:
+            variants = line.subproduct.product_size_color.all()
+            line.sizes = {sizes.name(variant.size_id) for variant in variants}
+            line.colors = {colors.name(variant.color_id) for variant in variants}
+    return CartSummary(lines, currency_type)
@@ -1,7 +1,22 @@
 
+from django.conf import settings
 from django.shortcuts import redirect
 from django.urls import reverse
 
+from app.currency import active_currency
+
+
+def currency_processor(request):
+    """Active currency for every template: code, symbol and the list to pick from"""
+    code = active_currency(request.session.get('currency'))
+    return {
+        'currency': code,
+        'currency_symbol': settings.CURRENCIES[code],
+        'currency_is_foreign': code != settings.BASE_CURRENCY,
+        'currencies': settings.CURRENCIES.items(),
+    }
+
+
 class AdminAccessMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -12,10 +27,10 @@ class AdminAccessMiddleware:
             path = path + '?' + request.META.get('QUERY_STRING')
         if '?currency=' in path:
             print('path true== ', path)
-            try:
-                request.session['currency'] = request.META.get('QUERY_STRING').split('=')[1]
-            except:
-                request.session['currency'] = request.META.get('QUERY_STRING')
+            code = (request.GET.get('currency') or '').strip().upper()
+            # unknown codes are ignored so the session only ever holds a configured currency
+            if code in settings.CURRENCIES:
+                request.session['currency'] = code
     
             return redirect('{}'.format(path.split('?')[0])) 
         # Assuming you have a named URL pattern for login page
@@ -1,11 +1,151 @@
+import bisect
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from decimal import Decimal, ROUND_HALF_UP
+
 import everapi
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the API while the circuit breaker is open"""
+    pass
+
+
+class BudgetExceeded(Exception):
+    """Raised when the time budget for API calls is used up"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Trips after `failure_threshold` consecutive failures. While open every
+    call is refused for `reset_timeout` seconds, then a single half-open
+    probe is let through: success closes the breaker, failure re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let exactly one probe through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Currency API circuit opened after {self.consecutive_failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
 
 # akhu badu band  karvu padse ..
 class Client(everapi.Client):
-    def __init__(self, api_key, base=None):
+    def __init__(self, api_key, base=None, timeout=None, breaker=None):
         if base is None:
-            base = f'https://api.freecurrencyapi.com/v1/latest?apikey={api_key}'
+            # api key is sent in the `apikey` header by everapi
+            base = 'https://api.freecurrencyapi.com/v1'
         super(Client, self).__init__(base, api_key)
+        # seconds allowed for a single HTTP call
+        self.timeout = timeout if timeout is not None else settings.CURRENCY_API_TIMEOUT
+        self.breaker = breaker or CircuitBreaker(settings.CURRENCY_BREAKER_THRESHOLD, settings.CURRENCY_BREAKER_RESET)
+        self.calls = 0
+        self.failures = 0
+        self.last_latency = None
+        self.total_latency = 0.0
+        self._deadline = threading.local()
+
+    @contextlib.contextmanager
+    def budget(self, seconds):
+        """Cap the total time of every call made inside the block"""
+        previous = getattr(self._deadline, 'value', None)
+        self._deadline.value = time.monotonic() + seconds
+        try:
+            yield
+        finally:
+            self._deadline.value = previous
+
+    def _request(self, url, method="GET", params=dict(), data=None, return_type=None):
+        timeout = self.timeout
+        deadline = getattr(self._deadline, 'value', None)
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise BudgetExceeded("Currency API time budget exceeded")
+
+        if not self.breaker.allow():
+            raise CircuitOpen("Currency API circuit is open")
+
+        if self.api_key:
+            self.headers['apikey'] = self.api_key
+
+        self.calls += 1
+        started = time.monotonic()
+        try:
+            response = requests.request(method, self.api_base + url, headers=self.headers,
+                                        params=params, json=data, timeout=timeout)
+            if response.status_code == 429:
+                raise everapi.exceptions.RateLimitExceeded()
+            elif response.status_code == 403:
+                raise everapi.exceptions.NotAllowed()
+            elif response.status_code == 401:
+                raise everapi.exceptions.IncorrectApikey()
+
+            response_obj = json.loads(response.text)
+            if "errors" in response_obj:
+                raise everapi.exceptions.ApiError("API returned errors:", response_obj['errors'])
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.last_latency = time.monotonic() - started
+            self.total_latency += self.last_latency
+
+        self.breaker.record_success()
+        return response_obj
+
+    def metrics(self):
+        return {
+            'breaker_state': self.breaker.state,
+            'consecutive_failures': self.breaker.consecutive_failures,
+            'calls': self.calls,
+            'failures': self.failures,
+            'last_latency_ms': round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+            'avg_latency_ms': round(self.total_latency / self.calls * 1000, 1) if self.calls else None,
+        }
 
     def status(self):
         return self._request('/status')
@@ -40,35 +180,305 @@ class Client(everapi.Client):
     def _list_to_comma_seperated(self, lst):
         return ','.join(lst)
 
-class INRToUSDConverter:
-    def __init__(self, api_key):
-        # Instantiate the client with the provided API key
+class ExchangeRateService:
+    """
+    Process-wide exchange rate table for every configured currency.
+
+    All rates are fetched with a single Client.latest() call and kept for
+    `ttl` seconds. After that the stale table is still served while a
+    background thread refreshes it (stale-while-revalidate), so page
+    rendering never waits on the API except for the very first fetch of
+    the process.
+    """
+
+    def __init__(self, api_key, base_currency='INR', currencies=('USD',), ttl=3600):
         self.client = Client(api_key)
+        self.base_currency = base_currency
+        self.currencies = list(currencies)
+        self.ttl = ttl
+        self._rates = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_rates(self):
+        if not self._rates:
+            with self._lock:
+                if not self._rates:
+                    self.refresh()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+        return self._rates
+
+    def get_rate(self, currency='USD'):
+        return self.get_rates().get(currency)
+
+    def refresh(self):
+        """
+        Fetch the rate table within CURRENCY_API_BUDGET seconds, retrying
+        while the budget allows after a jittered exponential backoff
+        (CURRENCY_RETRY_BACKOFF), so a failing provider is not hammered. On
+        failure the last known good rates are kept.
+        """
+        deadline = time.monotonic() + settings.CURRENCY_API_BUDGET
+        with self.client.budget(settings.CURRENCY_API_BUDGET):
+            for attempt in itertools.count():
+                try:
+                    response = self.client.latest(base_currency=self.base_currency, currencies=self.currencies)
+                except (CircuitOpen, BudgetExceeded) as e:
+                    logger.warning(f"Currency rate refresh skipped: {e}")
+                    break
+                except Exception as e:
+                    delay = settings.CURRENCY_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1)
+                    if time.monotonic() + delay >= deadline:
+                        logger.warning(f"Unable to retrieve exchange rates, giving up: {e}")
+                        break
+                    logger.warning(f"Unable to retrieve exchange rates, retrying in {delay:.2f}s: {e}")
+                    time.sleep(delay)
+                    continue
+
+                data = (response or {}).get('data', {})
+                rates = {currency: data[currency] for currency in self.currencies if data.get(currency) is not None}
+                if not rates:
+                    logger.warning("Unable to retrieve exchange rates. Empty response.")
+                    break
+                changed = {currency: rate for currency, rate in rates.items() if self._rates.get(currency) != rate}
+                # swap in a new dict so readers never see a half-updated table
+                self._rates = {**self._rates, **rates}
+                self._fetched_at = time.monotonic()
+                if changed:
+                    self._recompute_prices(self._rates)
+                break
+        return self._rates
+
+    @property
+    def cached_rates(self):
+        """Last fetched rate table, never triggers a fetch"""
+        return self._rates
+
+    def _recompute_prices(self, rates):
+        """
+        Rewrite the materialized ProductPrice rows for a new rate table, off
+        the request path. Every worker fetches the same new table, so only
+        the first one to claim it in the shared cache does the rewrite.
+        """
+        key = 'product_prices:' + ','.join(f'{code}={rate}' for code, rate in sorted(rates.items()))
+        if not cache.add(key, True, self.ttl):
+            return
+
+        def worker():
+            try:
+                refresh_product_prices(rates)
+            except Exception as e:
+                # let the next refresh (in any worker) try again
+                cache.delete(key)
+                logger.warning(f"Unable to refresh product prices: {e}")
+            finally:
+                connection.close()
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def metrics(self):
+        return {
+            **self.client.metrics(),
+            'rates': self._rates,
+            'rate_age_seconds': round(time.monotonic() - self._fetched_at) if self._rates else None,
+        }
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def worker():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=worker, daemon=True).start()
+
+
+_rate_service = None
+_rate_service_lock = threading.Lock()
+
+
+def get_rate_service():
+    global _rate_service
+    if _rate_service is None:
+        with _rate_service_lock:
+            if _rate_service is None:
+                _rate_service = ExchangeRateService(settings.CURRENCY_API_KEY, base_currency=settings.BASE_CURRENCY,
+                                                    currencies=foreign_currencies(), ttl=settings.CURRENCY_RATE_TTL)
+    return _rate_service
+
+
+def foreign_currencies():
+    """Configured currencies other than the one prices are stored in"""
+    return [code for code in settings.CURRENCIES if code != settings.BASE_CURRENCY]
+
+
+def active_currency(currency_type):
+    """Normalize a session currency value to a configured code, the base currency otherwise"""
+    code = (currency_type or '').strip().upper()
+    return code if code in settings.CURRENCIES else settings.BASE_CURRENCY
+
+
+def is_foreign(currency_type):
+    return active_currency(currency_type) != settings.BASE_CURRENCY
+
+
+def get_rate(currency='USD'):
+    """Cached base -> `currency` rate, None if it was never fetched successfully."""
+    return get_rate_service().get_rate(currency)
+
+
+def get_rates():
+    """The whole cached rate table, {currency: rate}"""
+    return get_rate_service().get_rates()
+
+
+def currency_metrics():
+    """Circuit breaker state and API latency of the shared rate service"""
+    return get_rate_service().metrics()
+
+
+CENTS = Decimal('0.01')
+
+
+def convert_many(prices, target_currency, rates=None):
+    """
+    Convert a list of base currency (INR) amounts to `target_currency` in
+    one pass.
+
+    `prices` can be plain numbers or the rows of a `values_list(...)`
+    queryset. The result is aligned with the input; None stays None.
+    Converted amounts are Decimals rounded half-up to cents, base currency
+    amounts are returned unchanged. `rates` optionally gives one rate per
+    price (see historical_rates()), otherwise the cached live rate is used.
+    If no rate is available the converted amount is None.
+    """
+    prices = [price[0] if isinstance(price, (tuple, list)) else price for price in prices]
+    target_currency = active_currency(target_currency)
+    if target_currency == settings.BASE_CURRENCY:
+        return prices
+
+    if rates is None:
+        rates = [get_rate(target_currency)] * len(prices)
+
+    converted = []
+    for price, rate in zip(prices, rates):
+        if price is None or rate is None:
+            converted.append(None)
+        else:
+            converted.append((Decimal(price) * Decimal(str(rate))).quantize(CENTS, rounding=ROUND_HALF_UP))
+    return converted
+
+
+def refresh_product_prices(rates=None, products=None):
+    """
+    Recompute the materialized ProductPrice rows of `products` (every
+    product when None) for every currency in `rates` with one read and
+    one bulk upsert. `rates` defaults to the cached rate table; nothing is
+    fetched, and nothing is written while no rate is known. Returns the
+    number of rows written.
+    """
+    from admin_app.models import Product, ProductPrice
+
+    if rates is None:
+        rates = get_rate_service().cached_rates
+    if not rates:
+        return 0
+
+    if products is None:
+        rows = list(Product.objects.values_list('id', 'price'))
+    else:
+        rows = [(product.id, product.price) for product in products]
+
+    prices = []
+    for currency, rate in rates.items():
+        amounts = convert_many([price for _, price in rows], currency, rates=[rate] * len(rows))
+        prices += [ProductPrice(product_id=product_id, currency=currency, amount=amount, rate=Decimal(str(rate)))
+                   for (product_id, _), amount in zip(rows, amounts) if amount is not None]
+
+    ProductPrice.objects.bulk_create(
+        prices,
+        update_conflicts=True,
+        unique_fields=['product', 'currency'],
+        update_fields=['amount', 'rate', 'updated_at'],
+        batch_size=500,
+    )
+    if products is None:
+        # new rates change every foreign-currency page
+        from app.page_cache import invalidate_pages
+        invalidate_pages()
+    return len(prices)
+
+
+def historical_rates(dates, currency='USD'):
+    """
+    Map every date to the stored ExchangeRate of that day, or of the
+    closest earlier snapshot, using at most two indexed queries.
+
+    Dates older than the first snapshot get the first snapshot, and if no
+    snapshot exists at all the cached live rate is used.
+    """
+    from app.models import ExchangeRate
+
+    base_currency = settings.BASE_CURRENCY
+    wanted = sorted({date for date in dates if date})
+    if not wanted:
+        return {}
+
+    snapshots = ExchangeRate.objects.filter(base_currency=base_currency, currency=currency)
+    start = snapshots.filter(date__lte=wanted[0]).order_by('-date').values_list('date', flat=True).first()
+    if start is not None:
+        snapshots = snapshots.filter(date__gte=start)
+    rows = list(snapshots.filter(date__lte=wanted[-1]).order_by('date').values_list('date', 'rate'))
+    if not rows:
+        rows = list(ExchangeRate.objects.filter(base_currency=base_currency, currency=currency)
+                    .order_by('date').values_list('date', 'rate')[:1])
+    if not rows:
+        rate = get_rate(currency)
+        return {date: rate for date in wanted}
+
+    snapshot_dates = [row[0] for row in rows]
+    return {date: rows[max(bisect.bisect_right(snapshot_dates, date) - 1, 0)][1] for date in wanted}
+
+
+def snapshot_rates(date=None, currencies=None):
+    """
+    Store the rates of `date` (today when None) in ExchangeRate, for every
+    configured currency unless `currencies` is given.
+
+    Today's rates come from one Client.latest() call, past dates from one
+    Client.historical() call. Returns the list of saved ExchangeRate rows.
+    """
+    from app.models import ExchangeRate
+
+    base_currency = settings.BASE_CURRENCY
+    currencies = currencies or foreign_currencies()
+    client = Client(settings.CURRENCY_API_KEY)
+    if date is None or date == datetime.date.today():
+        date = datetime.date.today()
+        response = client.latest(base_currency=base_currency, currencies=currencies)
+        data = (response or {}).get('data', {})
+    else:
+        response = client.historical(date.isoformat(), base_currency=base_currency, currencies=currencies)
+        data = (response or {}).get('data', {}).get(date.isoformat(), {})
+
+    saved = []
+    for currency in currencies:
+        rate = data.get(currency)
+        if rate is None:
+            logger.warning(f"No {base_currency} -> {currency} rate for {date}")
+            continue
+        obj, created = ExchangeRate.objects.update_or_create(
+            date=date, base_currency=base_currency, currency=currency,
+            defaults={'rate': Decimal(str(rate))},
+        )
+        saved.append(obj)
+    logger.info(f"Stored {len(saved)} {base_currency} exchange rate(s) for {date}")
+    return saved
 
-    def convert_inr_to_usd(self, amount_inr):
-        try:
-            # Get the latest exchange rates for INR to USD
-            response = self.client.latest(base_currency='INR', currencies=['USD'])
-            
-            # Print the entire response for inspection
-            # print(respsonse)
-
-            # Extract the exchange rate from the response
-            # Modify this part based on the actual structure of the response
-            if not response:
-                print("Error: Unable to retrieve exchange rate. Empty response.")
-                return None
-                
-            data = response.get('data', {})
-            exchange_rate = data.get('USD')
-            # Check if exchange_rate is None or not before proceeding
-            if exchange_rate is None:
-                print("Error: Unable to retrieve exchange rate.")
-                return None
-
-            # Convert the amount from INR to USD
-            amount_usd = amount_inr * exchange_rate
-            return amount_usd
-        except Exception as e:
-            print(f"Error: Unable to retrieve exchange rate. Exception: {e}")
-            return None
@@ -0,0 +1,144 @@
+"""
+Faceted filtering for category pages: size, color, price band and stock.
+
+Filters come from the query string (?size=<id>&color=<id>&in_stock=1 plus
+the price filters ?min_price=/&max_price=/&below_price=). Size, color and stock are matched
+on the same ProductSizeNColor row, so "M + Red + in stock" means one
+variant has all three.
+
+Counts are grouped aggregates, four queries per page whatever the number
+of products or variants. Each facet is counted with every *other* active
+filter applied, so picking a value shows how many products remain.
+"""
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef, Q
+
+from admin_app.models import ProductSizeNColor
+from . import reference
+from .currency import convert_many
+
+
+def _ids(values):
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except ValueError:
+            pass
+    return ids
+
+
+def parse_filters(request):
+    """The active size/color/stock filters of the request"""
+    return {
+        'sizes': _ids(request.GET.getlist('size')),
+        'colors': _ids(request.GET.getlist('color')),
+        'in_stock': request.GET.get('in_stock') == '1',
+    }
+
+
+def _variants(sizes=(), colors=(), in_stock=False):
+    variants = ProductSizeNColor.objects.all()
+    if sizes:
+        variants = variants.filter(size__in=sizes)
+    if colors:
+        variants = variants.filter(color__in=colors)
+    if in_stock:
+        variants = variants.filter(stock_quantity__gt=0)
+    return variants
+
+
+def _has_variant(sizes=(), colors=(), in_stock=False):
+    return Exists(_variants(sizes, colors, in_stock).filter(subproduct=OuterRef('pk')))
+
+
+def filter_variants(queryset, sizes=(), colors=(), in_stock=False):
+    """SubProducts of `queryset` with at least one variant matching all the given filters"""
+    if not (sizes or colors or in_stock):
+        return queryset
+    return queryset.filter(_has_variant(sizes, colors, in_stock))
+
+
+def _toggle_url(request, name, value):
+    params = request.GET.copy()
+    values = params.getlist(name)
+    if str(value) in values:
+        values.remove(str(value))
+    else:
+        values.append(str(value))
+    params.setlist(name, values)
+    return '?' + params.urlencode()
+
+
+def _price_url(request, low, high):
+    """Link to the price band [low, high)"""
+    params = request.GET.copy()
+    for name in ('min_price', 'max_price', 'below_price'):
+        params.pop(name, None)
+    if low is not None:
+        params['min_price'] = low
+    if high is not None:
+        params['below_price'] = high
+    return '?' + params.urlencode()
+
+
+def price_bands(currency_type):
+    """PRICE_BANDS (base currency edges) in the active currency, [] while no rate is known"""
+    edges = convert_many(settings.PRICE_BANDS, currency_type)
+    if any(edge is None for edge in edges):
+        return []
+    return [(low, high) for low, high in zip(edges, edges[1:])] + [(edges[-1], None)]
+
+
+def _option_counts(priced, field, filters, other, other_key):
+    """Products per value of `field` ('size' or 'color'), honouring the other attribute and stock"""
+    other_values = filters[other_key]
+    variants = _variants(in_stock=filters['in_stock']).filter(subproduct__in=priced.values('pk'))
+    if other_values:
+        variants = variants.filter(**{other + '__in': other_values})
+    names = reference.sizes() if field == 'size' else reference.colors()
+    rows = variants.values(field + '_id').annotate(count=Count('subproduct', distinct=True)).order_by()
+    return sorted(({'id': row[field + '_id'], 'name': names.name(row[field + '_id']), 'count': row['count']}
+                   for row in rows), key=lambda row: row['name'] or '')
+
+
+def facet_counts(request, queryset, priced, filters):
+    """
+    Facet options with counts for the template.
+
+    `queryset` is the category's with_display_price() queryset and
+    `priced` the same with the price range filter applied.
+    """
+    options = {}
+    for field, other, key, other_key in (('size', 'color', 'sizes', 'colors'), ('color', 'size', 'colors', 'sizes')):
+        options[key] = [dict(row, selected=row['id'] in filters[key], url=_toggle_url(request, field, row['id']))
+                        for row in _option_counts(priced, field, filters, other, other_key)]
+
+    in_stock = filter_variants(priced, filters['sizes'], filters['colors']).aggregate(
+        count=Count('pk', filter=Q(_has_variant(filters['sizes'], filters['colors'], True))))['count']
+    params = request.GET.copy()
+    if filters['in_stock']:
+        params.pop('in_stock')
+    else:
+        params['in_stock'] = '1'
+    options['in_stock'] = {'count': in_stock, 'selected': filters['in_stock'], 'url': '?' + params.urlencode()}
+
+    bands = price_bands(request.session.get('currency'))
+    conditions = {}
+    for i, (low, high) in enumerate(bands):
+        # upper edges are exclusive, so a price on an edge is counted once
+        condition = Q(display_price__gte=low)
+        if high is not None:
+            condition &= Q(display_price__lt=high)
+        conditions[f'band_{i}'] = Count('pk', filter=condition)
+    counts = filter_variants(queryset, **filters).aggregate(**conditions) if conditions else {}
+    current = (request.GET.get('min_price'), request.GET.get('below_price'))
+    options['price_bands'] = [{
+        'min': low,
+        'max': high,
+        'count': counts[f'band_{i}'],
+        'selected': current == (str(low), str(high) if high is not None else None),
+        'url': _price_url(request, low, high),
+    } for i, (low, high) in enumerate(bands)]
+    options['clear_price_url'] = _price_url(request, None, None)
+    return options
@@ -0,0 +1,122 @@
+"""
+Idempotency keys for the order and payment endpoints.
+
+A view wrapped with @idempotent(scope) reads a key from the request
+(the Idempotency-Key header or an idempotency_key parameter by default,
+or something like the payment id for the payment callbacks). The first
+request with a key claims it by inserting an IdempotencyKey row, which
+the unique (user, scope, key) constraint makes atomic. A retry with the
+same key gets the stored response replayed without redoing any work; a
+retry that arrives while the first request is still running waits up to
+IDEMPOTENCY_WAIT seconds for it, then answers 409.
+
+Only requests that placed an order are remembered: the view marks them
+by setting request.idempotent_order. Anything else (an empty cart, a
+declined payment) releases the key, so the client can fix the problem
+and retry with the same key.
+"""
+import datetime
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+
+def request_key(request):
+    """The Idempotency-Key header, or an idempotency_key form/query parameter"""
+    return (request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key')
+            or request.GET.get('idempotency_key'))
+
+
+def json_key(field):
+    """Key function reading `field` from a JSON request body, e.g. the payment id of a payment callback"""
+    def key(request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data.get(field) if isinstance(data, dict) else None
+    return key
+
+
+def _replay(record):
+    response = HttpResponse(record.response_body, status=record.response_status)
+    for header, value in record.response_headers.items():
+        response[header] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(user_id, scope, key):
+    """(IdempotencyKey claimed for this request, None) or (None, response to send instead)"""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    while True:
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(user_id=user_id, scope=scope, key=key), None
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(user_id=user_id, scope=scope, key=key).first()
+        if record is None:
+            # released in the meantime
+            continue
+        now = timezone.now()
+        if record.response_status is not None:
+            if record.created_at >= now - datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL):
+                return None, _replay(record)
+            record.delete()
+        elif record.created_at < now - datetime.timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            # the request holding the key died without answering
+            IdempotencyKey.objects.filter(pk=record.pk, response_status__isnull=True).delete()
+        elif time.monotonic() >= deadline:
+            return None, JsonResponse({'success': False, 'error': 'This request is already being processed'}, status=409)
+        else:
+            time.sleep(0.2)
+
+
+def idempotent(scope, key_func=request_key):
+    """Replay the stored response when a logged-in user repeats a request with the same key"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            user_id = request.session.get('user')
+            key = key_func(request)
+            if not user_id or not key:
+                return view(request, *args, **kwargs)
+
+            record, response = _claim(user_id, scope, str(key)[:255])
+            if response is not None:
+                return response
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+
+            order = getattr(request, 'idempotent_order', None)
+            if order is None:
+                record.delete()
+                return response
+            record.order = order
+            record.response_status = response.status_code
+            record.response_body = response.content.decode(response.charset or 'utf-8')
+            record.response_headers = {header: response[header] for header in REPLAYED_HEADERS if response.has_header(header)}
+            record.save(update_fields=['order', 'response_status', 'response_body', 'response_headers'])
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired_keys(now=None):
+    """Delete the keys older than IDEMPOTENCY_KEY_TTL with a single DELETE"""
+    cutoff = (now or timezone.now()) - datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    return IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()[0]
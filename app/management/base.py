@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicCommand(BaseCommand):
+    """
+    A job run once (from cron) or, with --loop SECONDS, kept running by a
+    scheduler process (the scheduler service in docker-compose.yml).
+    Subclasses implement run_once(), returning the line to report.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, metavar='SECONDS', help='Keep running, once every SECONDS')
+
+    def run_once(self, **options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self.stdout.write(self.run_once(**options))
+            return
+        while True:
+            try:
+                self.stdout.write(self.run_once(**options))
+            except Exception:
+                # one failed run (e.g. "database is locked") must not stop the schedule
+                logger.exception(f"{self.__module__} failed, retrying in {options['loop']}s")
+            time.sleep(options['loop'])
@@ -0,0 +1,9 @@
+from app.management.base import PeriodicCommand
+from app.orders import deliver_due_orders
+
+
+class Command(PeriodicCommand):
+    help = 'Mark pending orders past their delivery date as Delivered (run from cron, or with --loop)'
+
+    def run_once(self, **options):
+        return f'{deliver_due_orders()} order(s) marked as Delivered'
@@ -0,0 +1,9 @@
+from app.idempotency import purge_expired_keys
+from app.management.base import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    help = 'Delete idempotency keys older than IDEMPOTENCY_KEY_TTL (run from cron, or with --loop)'
+
+    def run_once(self, **options):
+        return f'{purge_expired_keys()} expired idempotency key(s) deleted'
@@ -0,0 +1,19 @@
+from django.conf import settings
+
+from app.bestsellers import rebuild_bestsellers
+from app.management.base import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    help = 'Recompute the cached bestseller ranking (run from cron, or with --loop)'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--days', type=int, nargs='*',
+                            help='Windows to rebuild in days, 0 for all time (default: BESTSELLER_WINDOW_DAYS)')
+        parser.add_argument('--limit', type=int, default=10)
+
+    def run_once(self, **options):
+        windows = options['days'] if options['days'] is not None else [settings.BESTSELLER_WINDOW_DAYS]
+        return '\n'.join(f'{days or "all"} days: {rebuild_bestsellers(days or None, options["limit"])}'
+                         for days in windows)
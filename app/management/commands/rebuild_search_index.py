@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from admin_app.models import SubProduct
+from app.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product full-text search index (after imports that bypass model signals)'
+
+    def handle(self, *args, **options):
+        rebuild_search_index()
+        self.stdout.write(f'Indexed {SubProduct.objects.count()} products')
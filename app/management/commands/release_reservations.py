@@ -0,0 +1,9 @@
+from app.management.base import PeriodicCommand
+from app.reservations import release_expired_reservations
+
+
+class Command(PeriodicCommand):
+    help = 'Delete expired checkout stock reservations (run from cron, or with --loop)'
+
+    def run_once(self, **options):
+        return f'{release_expired_reservations()} expired reservation(s) released'
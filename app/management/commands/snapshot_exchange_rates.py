@@ -0,0 +1,31 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.currency import snapshot_rates
+
+
+class Command(BaseCommand):
+    help = "Store today's INR exchange rates (run daily from cron), or backfill past days"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Snapshot a single day (YYYY-MM-DD) instead of today')
+        parser.add_argument('--days', type=int, default=0, help='Also backfill this many days before the date')
+
+    def handle(self, *args, **options):
+        date = datetime.date.today()
+        if options['date']:
+            try:
+                date = datetime.date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError('--date must be in YYYY-MM-DD format')
+
+        for offset in range(options['days'], -1, -1):
+            day = date - datetime.timedelta(days=offset)
+            try:
+                saved = snapshot_rates(day)
+            except Exception as e:
+                self.stderr.write(f'{day}: {e}')
+                continue
+            for obj in saved:
+                self.stdout.write(str(obj))
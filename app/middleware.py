@@ -1,6 +1,9 @@
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
 from django.shortcuts import redirect
+from .models import Cart, User
 from .utils import encode_id, decode_id
+from .visitors import visitor_count
 
 class OrderIdHashMiddleware(MiddlewareMixin):
     def process_view(self, request, view_func, view_args, view_kwargs):
@@ -16,4 +19,47 @@ class OrderIdHashMiddleware(MiddlewareMixin):
             del view_kwargs['hashed_order_id']
         
         return None
-    
\ No newline at end of file
+
+
+def build_user_context(request):
+    """
+    Storefront user info shared by the templates: the logged in user row,
+    cart item count (a COUNT query) and the visitor counter.
+    """
+    context = {'visitor': visitor_count()}
+
+    user_id = request.session.get('user')
+    if user_id is None:
+        return context
+    try:
+        user = User.objects.get(pk=user_id)
+    except (User.DoesNotExist, TypeError, ValueError):
+        return context
+
+    names = (user.name or '').split(' ')
+    context.update({
+        'user': user,
+        'total_items': Cart.objects.filter(uname=user).count(),
+        'firstname': names[0],
+        'lastname': names[1] if len(names) > 1 else '',
+    })
+    return context
+
+
+def get_user_context(request):
+    """The request's user context, built on first use"""
+    if not hasattr(request, 'user_context'):
+        request.user_context = SimpleLazyObject(lambda: build_user_context(request))
+    return request.user_context
+
+
+class UserContextMiddleware:
+    """Attach a lazy request.user_context, so it costs nothing on pages that never use it
+    and at most one round of small queries on pages that do."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        get_user_context(request)
+        return self.get_response(request)
+
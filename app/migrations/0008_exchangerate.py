@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_alter_review_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('base_currency', models.CharField(default='INR', max_length=3)),
+                ('currency', models.CharField(default='USD', max_length=3)),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=18)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Exchange Rates',
+                'ordering': ['-date'],
+                'unique_together': {('base_currency', 'currency', 'date')},
+            },
+        ),
+    ]
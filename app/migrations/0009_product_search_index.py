@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # SQLite only: PostgreSQL searches with to_tsvector at query time
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS app_product_search USING fts5("
+        "name, description, category, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    schema_editor.execute(
+        "INSERT INTO app_product_search (rowid, name, description, category) "
+        "SELECT s.id, p.name, s.description, c.name FROM admin_app_subproduct s "
+        "JOIN admin_app_product p ON p.id = s.product_id "
+        "JOIN admin_app_category c ON c.id = p.category_id"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS app_product_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_app', '0009_productprice'),
+        ('app', '0008_exchangerate'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
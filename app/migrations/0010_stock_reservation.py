@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_app', '0009_productprice'),
+        ('app', '0009_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='admin_app.productsizencolor')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='app.user')),
+            ],
+            options={
+                'verbose_name_plural': 'Stock Reservations',
+                'indexes': [models.Index(fields=['stock', 'expires_at'], name='app_stockre_stock_i_16ca86_idx'), models.Index(fields=['expires_at'], name='app_stockre_expires_f76765_idx')],
+                'unique_together': {('user', 'stock')},
+            },
+        ),
+    ]
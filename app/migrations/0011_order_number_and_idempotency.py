@@ -0,0 +1,54 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# must match app.orders.ORDER_NUMBER_BASE
+ORDER_NUMBER_BASE = 1000000
+
+
+def renumber_orders(apps, schema_editor):
+    """Give orders without a number, and all but the first of each duplicated number, a new unique one"""
+    placeOrder = apps.get_model('app', 'placeOrder')
+    seen = set()
+    changed = []
+    for order in placeOrder.objects.order_by('id'):
+        if order.order_id is None or order.order_id in seen:
+            order.order_id = ORDER_NUMBER_BASE + order.id
+            changed.append(order)
+        seen.add(order.order_id)
+    placeOrder.objects.bulk_update(changed, ['order_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_orders, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='placeorder',
+            name='order_id',
+            field=models.IntegerField(null=True, unique=True),
+        ),
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=255)),
+                ('response_status', models.PositiveSmallIntegerField(null=True)),
+                ('response_body', models.TextField(blank=True, default='')),
+                ('response_headers', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.placeorder')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to='app.user')),
+            ],
+            options={
+                'verbose_name_plural': 'Idempotency Keys',
+                'unique_together': {('user', 'scope', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # PostgreSQL only: SQLite has the FTS5 table from 0009
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "CREATE TABLE IF NOT EXISTS app_product_search ("
+        "subproduct_id bigint PRIMARY KEY REFERENCES admin_app_subproduct (id) ON DELETE CASCADE, "
+        "document tsvector NOT NULL)"
+    )
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS app_product_search_document ON app_product_search USING gin (document)"
+    )
+    schema_editor.execute(
+        "INSERT INTO app_product_search (subproduct_id, document) "
+        "SELECT s.id, setweight(to_tsvector(coalesce(p.name, '')), 'A') "
+        "|| setweight(to_tsvector(coalesce(c.name, '')), 'B') "
+        "|| setweight(to_tsvector(coalesce(s.description, '')), 'C') "
+        "FROM admin_app_subproduct s "
+        "JOIN admin_app_product p ON p.id = s.product_id "
+        "JOIN admin_app_category c ON c.id = p.category_id "
+        "ON CONFLICT (subproduct_id) DO NOTHING"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS app_product_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_order_number_and_idempotency'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
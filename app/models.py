@@ -2,7 +2,7 @@ from django.db import models
 from django.contrib.auth.models import User as User_1
 from django.contrib.auth.hashers import make_password
 from datetime import timedelta
-from admin_app.models import SubProduct
+from admin_app.models import ProductSizeNColor, SubProduct
 from django.dispatch import receiver
 from django.db.models.signals import post_save, post_delete
 # from social_django.models import UserSocialAuth
@@ -81,7 +81,7 @@ class placeOrder(models.Model):
     total_amount = models.IntegerField(null=True)
     delivery_date = models.DateField(null=True)
     # transaction_id = models.CharField(max_length=30, blank=True, null=True)
-    order_id = models.IntegerField(null=True)
+    order_id = models.IntegerField(null=True, unique=True)
     order_status = models.CharField(max_length=50, default='Pending')  
 
     def __str__(self):
@@ -153,6 +153,24 @@ class Visitor(models.Model):
     count = models.IntegerField(default=0)
 
 
+class ExchangeRate(models.Model):
+    """Daily exchange rate snapshot, orders are priced at the rate of their order date"""
+    date = models.DateField()
+    base_currency = models.CharField(max_length=3, default='INR')
+    currency = models.CharField(max_length=3, default='USD')
+    rate = models.DecimalField(max_digits=18, decimal_places=10)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-date']
+        unique_together = ('base_currency', 'currency', 'date')
+        verbose_name_plural = 'Exchange Rates'
+
+    def __str__(self):
+        return f'{self.date} | {self.base_currency} -> {self.currency} | {self.rate}'
+
+
 class Review(models.Model):
     """Product Review Model"""
     RATING_CHOICES = [
@@ -188,6 +206,46 @@ class Review(models.Model):
         return (self.rating / 5) * 100
 
 
+
+
+class StockReservation(models.Model):
+    """Units of a variant held for a shopper between checkout and payment, ignored once expires_at has passed"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='stock_reservations')
+    stock = models.ForeignKey(ProductSizeNColor, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'Stock Reservations'
+        unique_together = ('user', 'stock')
+        # active reservations of a variant are summed on every stock check
+        indexes = [models.Index(fields=['stock', 'expires_at']), models.Index(fields=['expires_at'])]
+
+    def __str__(self):
+        return f'{self.user.user_name} | {self.stock_id} x {self.quantity} until {self.expires_at}'
+
+
+
+class IdempotencyKey(models.Model):
+    """A client's key for one order/payment request and the response it got, replayed when the request is retried"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    order = models.ForeignKey(placeOrder, on_delete=models.SET_NULL, null=True, blank=True)
+    # null while the first request is still running
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_body = models.TextField(blank=True, default='')
+    response_headers = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = 'Idempotency Keys'
+        unique_together = ('user', 'scope', 'key')
+
+    def __str__(self):
+        return f'{self.user.user_name} | {self.scope} | {self.key}'
+
     
     
 @receiver(post_save, sender=User_1)
@@ -0,0 +1,153 @@
+import datetime
+import logging
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+
+from admin_app.models import ProductSizeNColor
+from src.payment.models import Payment
+from .carts import shipping_charge
+from .models import Cart, StockReservation, placeOrder, sub_placeorder
+from .page_cache import invalidate_stock_pages
+from .product_detail import invalidate_product_details
+from .stock import allocate, cart_triple, stock_rows
+
+logger = logging.getLogger(__name__)
+
+# order numbers are ORDER_NUMBER_BASE + primary key, well clear of the older timestamp-based numbers
+ORDER_NUMBER_BASE = 1000000
+
+
+class OrderConflict(Exception):
+    """The cart or the stock changed while the order was being placed; nothing was written"""
+
+
+def deliver_due_orders(today=None):
+    """Mark every pending order whose delivery date has passed as Delivered with a single UPDATE"""
+    today = today or datetime.date.today()
+    delivered = placeOrder.objects.filter(order_status='Pending', delivery_date__lt=today).update(order_status='Delivered')
+    logger.info(f"Marked {delivered} pending order(s) as Delivered")
+    return delivered
+
+
+def assign_order_number(order):
+    """
+    Give a freshly inserted order its customer-facing number. Derived from
+    the primary key, so two orders can never share one (the column is
+    unique as well).
+    """
+    order.order_id = ORDER_NUMBER_BASE + order.pk
+    placeOrder.objects.filter(pk=order.pk).update(order_id=order.order_id)
+
+
+def _take_stock(taken):
+    """
+    Subtract {stock row id: quantity} in one UPDATE that only touches rows
+    still holding enough stock; any shortfall aborts the order.
+    """
+    if not taken:
+        return
+    updated = ProductSizeNColor.objects.filter(
+        reduce(or_, (Q(pk=row_id, stock_quantity__gte=quantity) for row_id, quantity in taken.items()))
+    ).update(stock_quantity=Case(
+        *(When(pk=row_id, then=F('stock_quantity') - quantity) for row_id, quantity in taken.items()),
+        default=F('stock_quantity'),
+        output_field=PositiveIntegerField(),
+    ))
+    if updated != len(taken):
+        raise OrderConflict('stock ran out while placing the order')
+
+
+def place_cart_order(user, address, payment_mode='COD', order_status='Pending', payment=None, allow_partial=True):
+    """
+    Turn the user's cart into an order: the one checkout pipeline behind
+    the COD, Stripe and PayPal paths.
+
+    In a single transaction it validates the cart (one locked SELECT),
+    reserves stock (one locked SELECT of the stock rows, then one
+    conditional UPDATE), writes the order and a bulk_create of its lines,
+    records the Payment, drops the shopper's stock reservations and
+    empties the cart with one DELETE.
+
+    `payment` holds the Payment fields (method, status, payment_id, ...);
+    amount and currency default to the order total in BASE_CURRENCY.
+    With `allow_partial` each line gets whatever is in stock, but a cart
+    with nothing in stock at all is an OrderConflict; without it (orders
+    already paid for) any shortfall is an OrderConflict.
+
+    Returns the placeOrder, or None for an empty cart. On OrderConflict
+    nothing has been written.
+    """
+    with transaction.atomic():
+        lines = list(Cart.objects.select_for_update(of=('self',)).filter(uname=user)
+                     .select_related('subproduct__product').order_by('created_at', 'id'))
+        if not lines:
+            return None
+        if any(not line.size or not line.color for line in lines):
+            raise OrderConflict('a cart line has no size or color chosen')
+
+        # units other shoppers hold in unexpired reservations are not available to this order
+        rows = stock_rows([cart_triple(line) for line in lines], for_update=True, exclude_user=user)
+        allocations = allocate(lines, rows)
+        if not allow_partial and any(quantity < line.quantity for line, _, quantity in allocations):
+            raise OrderConflict('not enough stock for every item in the cart')
+        bought = [(line, row, quantity) for line, row, quantity in allocations if quantity > 0]
+        if not bought:
+            raise OrderConflict('nothing in the cart is in stock')
+
+        shipping = shipping_charge(settings.BASE_CURRENCY)
+        total = sum(quantity * line.subproduct.product.price for line, _, quantity in bought)
+        order_date = datetime.date.today()
+        order = placeOrder.objects.create(
+            user_id=user,
+            address_id=address,
+            order_date=order_date,
+            payment_mode=payment_mode,
+            delivery_date=order_date + datetime.timedelta(days=7),
+            shipping_charge=shipping,
+            total_quantity=sum(quantity for _, _, quantity in bought),
+            total_amount=total + shipping,
+            order_status=order_status,
+        )
+        assign_order_number(order)
+        sub_placeorder.objects.bulk_create([
+            sub_placeorder(
+                order_id=order,
+                subproduct_id=line.subproduct,
+                size=line.size,
+                color=line.color,
+                quantity=quantity,
+                price=quantity * line.subproduct.product.price,
+            ) for line, _, quantity in bought
+        ])
+
+        taken = {}
+        for _, row, quantity in bought:
+            taken[row.id] = taken.get(row.id, 0) + quantity
+        _take_stock(taken)
+
+        if payment is not None:
+            Payment.objects.create(**{
+                'amount': order.total_amount,
+                'currency': settings.BASE_CURRENCY,
+                **payment,
+                'user': user,
+                'placed_order': order,
+            })
+
+        # the shopper's reservations are now real decrements
+        StockReservation.objects.filter(user=user).delete()
+        deleted, _ = Cart.objects.filter(pk__in=[line.pk for line in lines]).delete()
+        if deleted != len(lines):
+            raise OrderConflict('the cart was checked out by another request')
+
+        # the bulk UPDATE sends no signals, so drop the cached stock by hand once committed,
+        # only for the products sold: the rest of the page cache stays warm
+        subproduct_ids = {line.subproduct_id for line, _, _ in bought}
+        transaction.on_commit(lambda: (invalidate_product_details(subproduct_ids), invalidate_stock_pages(subproduct_ids)))
+
+    logger.info(f"Placed {payment_mode} order {order.order_id} with {len(bought)} line(s) for user {user.id}")
+    return order
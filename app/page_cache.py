@@ -0,0 +1,147 @@
+"""
+Whole-page cache for the anonymous storefront (home, section, about, product page).
+
+Pages are stored per path + query string + active currency and only ever
+served to, or filled from, visitors who are not logged in. Every cached
+key carries a catalog version kept in the shared cache (see versions.py),
+so saving or deleting a product, subproduct or review in any worker
+replaces the version for all of them, which makes all stored pages
+unreachable at once (they then age out of the cache).
+
+Stock changes far more often than the catalog (every order), so product
+and section pages also carry a version of their own scope (see
+product_pages, section_pages) and a stock change only replaces the
+versions of the products it touched and their categories.
+
+The CSRF token differs per visitor, so cached HTML holds a placeholder
+that is swapped for the current visitor's token on the way out.
+"""
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+from admin_app.models import Product, ProductSizeNColor, SubProduct
+from app.currency import active_currency
+from app.models import Review
+from app.versions import bump_version, current_version
+
+VERSION_CACHE_KEY = 'page_cache_version'
+PRODUCT_VERSION_KEY = 'page_cache_product:{}'
+SECTION_VERSION_KEY = 'page_cache_section:{}'
+CSRF_PLACEHOLDER = '__page_cache_csrf_token__'
+
+
+def catalog_version():
+    return current_version(VERSION_CACHE_KEY)
+
+
+def invalidate_pages(**kwargs):
+    """Drop every cached page; used as the receiver for catalog changes"""
+    bump_version(VERSION_CACHE_KEY)
+
+
+def product_pages(id, **kwargs):
+    """Scope of show_product: the version key of one subproduct's pages"""
+    return PRODUCT_VERSION_KEY.format(id)
+
+
+def section_pages(cate, **kwargs):
+    """Scope of section: the version key of one category's pages"""
+    return SECTION_VERSION_KEY.format(cate.lower())
+
+
+def invalidate_stock_pages(subproduct_ids):
+    """Drop the cached product and section pages showing the stock of `subproduct_ids`"""
+    subproduct_ids = set(subproduct_ids)
+    categories = set(SubProduct.objects.filter(pk__in=subproduct_ids)
+                     .values_list('product__category__name', flat=True))
+    for subproduct_id in subproduct_ids:
+        bump_version(PRODUCT_VERSION_KEY.format(subproduct_id))
+    for name in categories:
+        if name is not None:
+            bump_version(SECTION_VERSION_KEY.format(name.lower()))
+
+
+def is_cacheable(request):
+    """Only plain GETs from anonymous visitors with no pending flash messages"""
+    if request.method != 'GET' or request.session.get('user'):
+        return False
+    if request.user.is_authenticated:
+        return False
+    if 'messages' in request.COOKIES or request.session.get('_messages'):
+        return False
+    return True
+
+
+def page_key(request, scope_key=None):
+    currency = active_currency(request.session.get('currency'))
+    scope_version = current_version(scope_key) if scope_key else ''
+    return 'page:{}:{}:{}:{}'.format(catalog_version(), scope_version, currency, request.get_full_path())
+
+
+def csrf_processor(request):
+    """Template context processor: render a placeholder token while a page is being stored"""
+    if getattr(request, '_page_cache_render', False):
+        return {'csrf_token': CSRF_PLACEHOLDER}
+    return {}
+
+
+def _with_token(request, content):
+    placeholder = CSRF_PLACEHOLDER.encode()
+    if placeholder not in content:
+        return content
+    return content.replace(placeholder, get_token(request).encode())
+
+
+def cache_anonymous_page(view=None, scope=None):
+    """
+    Serve `view` from the page cache for anonymous visitors, always fresh
+    for logged-in users. `scope`, called with the view's URL arguments,
+    names the extra version key the page depends on.
+    """
+    if view is None:
+        return partial(cache_anonymous_page, scope=scope)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_cacheable(request):
+            return view(request, *args, **kwargs)
+
+        key = page_key(request, scope(*args, **kwargs) if scope else None)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(_with_token(request, content), content_type=content_type)
+
+        request._page_cache_render = True
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            request._page_cache_render = False
+        if response.streaming:
+            return response
+
+        content = response.content
+        if response.status_code == 200:
+            cache.set(key, (content, response['Content-Type']), settings.PAGE_CACHE_TTL)
+        response.content = _with_token(request, content)
+        return response
+    return wrapper
+
+
+def _stock_changed(sender, instance, **kwargs):
+    invalidate_stock_pages(instance.subproduct_set.values_list('id', flat=True))
+
+
+for model in (Product, SubProduct, Review):
+    post_save.connect(invalidate_pages, sender=model, dispatch_uid='page_cache_save_{}'.format(model.__name__))
+    post_delete.connect(invalidate_pages, sender=model, dispatch_uid='page_cache_delete_{}'.format(model.__name__))
+post_save.connect(_stock_changed, sender=ProductSizeNColor, dispatch_uid='page_cache_stock_saved')
+# pre_delete: the rows linking a stock row to its subproducts are already gone by post_delete
+pre_delete.connect(_stock_changed, sender=ProductSizeNColor, dispatch_uid='page_cache_stock_deleted')
+m2m_changed.connect(invalidate_pages, sender=SubProduct.product_size_color.through,
+                    dispatch_uid='page_cache_stock_rows')
@@ -0,0 +1,145 @@
+"""
+Keyset (seek) pagination shared by the storefront and admin list views.
+
+Instead of OFFSET, a page continues from the sort key of the last row it
+showed: `WHERE (created_at, id) < (:created_at, :id) ORDER BY created_at
+DESC, id DESC LIMIT n`. Every page costs the same no matter how deep it
+is, and rows inserted meanwhile never shift a page.
+
+The position travels in ?cursor=, a signed opaque token, so it cannot be
+edited by hand. ?per_page= is capped at PAGE_SIZE_MAX.
+"""
+from django.conf import settings
+from django.core import signing
+from django.db.models import F, Q
+
+CURSOR_SALT = 'app.pagination'
+
+
+class Page:
+    def __init__(self, items, request, next_key=None, prev_key=None):
+        self.items = items
+        self.next_url = _page_url(request, next_key, 'n') if next_key is not None else None
+        self.prev_url = _page_url(request, prev_key, 'p') if prev_key is not None else None
+        self.has_next = next_key is not None
+        self.has_prev = prev_key is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _page_url(request, key, direction):
+    params = request.GET.copy()
+    params['cursor'] = signing.dumps({'k': key, 'd': direction}, salt=CURSOR_SALT, compress=True)
+    return '?' + params.urlencode()
+
+
+def _read_cursor(request):
+    token = request.GET.get('cursor')
+    if not token:
+        return None, 'n'
+    try:
+        cursor = signing.loads(token, salt=CURSOR_SALT)
+        return cursor['k'], cursor['d']
+    except (signing.BadSignature, KeyError, TypeError):
+        return None, 'n'
+
+
+def page_size(request, per_page=None):
+    per_page = per_page or settings.PAGE_SIZE
+    try:
+        per_page = int(request.GET.get('per_page', per_page))
+    except ValueError:
+        pass
+    return max(1, min(per_page, settings.PAGE_SIZE_MAX))
+
+
+def _parse_keys(keys):
+    return [(key.lstrip('-'), key.startswith('-')) for key in keys]
+
+
+def _order_by(keys, reverse):
+    """ORDER BY for `keys`, nulls last; fully inverted (nulls first) when reading backwards"""
+    nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+    order = []
+    for field, descending in keys:
+        if descending != reverse:
+            order.append(F(field).desc(**nulls))
+        else:
+            order.append(F(field).asc(**nulls))
+    return order
+
+
+def _seek(keys, values, reverse, nullable):
+    """Q matching the rows after (or before, when `reverse`) `values` in the keys' order, nulls last"""
+    condition = Q(pk__in=[])
+    equal = Q()
+    for (field, descending), value in zip(keys, values):
+        later = descending != reverse
+        if value is None:
+            # nothing sorts after a null; only the rows before it (non-null values) when reversing
+            step = Q(**{f'{field}__isnull': False}) if reverse else Q(pk__in=[])
+            match = Q(**{f'{field}__isnull': True})
+        else:
+            step = Q(**{f'{field}__lt' if later else f'{field}__gt': value})
+            if field in nullable and not reverse:
+                step |= Q(**{f'{field}__isnull': True})
+            match = Q(**{field: value})
+        condition |= equal & step
+        equal &= match
+    return condition
+
+
+def _key_values(item, keys):
+    values = []
+    for field, _ in keys:
+        value = getattr(item, field)
+        values.append(value if value is None or isinstance(value, (int, str)) else str(value))
+    return values
+
+
+def paginate(queryset, request, keys=('-created_at', '-id'), per_page=None, nullable=()):
+    """
+    One page of `queryset` ordered by `keys` (the last one must be unique,
+    normally the id). Fields listed in `nullable` may be null; nulls sort last.
+    """
+    keys = _parse_keys(keys)
+    per_page = page_size(request, per_page)
+    values, direction = _read_cursor(request)
+    reverse = values is not None and direction == 'p'
+
+    queryset = queryset.order_by(*_order_by(keys, reverse))
+    if values is not None and len(values) == len(keys):
+        queryset = queryset.filter(_seek(keys, values, reverse, set(nullable)))
+    else:
+        values = None
+    items = list(queryset[:per_page + 1])
+    more = len(items) > per_page
+    items = items[:per_page]
+    if reverse:
+        items.reverse()
+
+    next_key = prev_key = None
+    if items:
+        if more or reverse:
+            next_key = _key_values(items[-1], keys)
+        if values is not None and (more or not reverse):
+            prev_key = _key_values(items[0], keys)
+    return Page(items, request, next_key, prev_key)
+
+
+def paginate_sequence(sequence, request, per_page=None):
+    """One page of an already ordered list (e.g. ranked search hits), the cursor being the position"""
+    per_page = page_size(request, per_page)
+    position, direction = _read_cursor(request)
+    if not isinstance(position, int):
+        position, direction = 0, 'n'
+    start = max(0, position - per_page) if direction == 'p' else position
+    items = sequence[start:start + per_page]
+    end = start + len(items)
+    return Page(items, request,
+                next_key=end if end < len(sequence) else None,
+                prev_key=start if start > 0 else None)
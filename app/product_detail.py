@@ -0,0 +1,110 @@
+"""
+Cached read model for the product page.
+
+Everything show_product needs about a SubProduct (names, base price,
+image, sizes, colors and the size -> color -> stock matrix) is built
+from one select_related query plus one prefetch, stored as a plain dict
+and cached per product. Saving or deleting the product, the subproduct
+or one of its stock rows drops the cached entry.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+
+from admin_app.models import Category, Product, ProductSizeNColor, SubProduct
+
+
+def _cache_key(subproduct_id):
+    return f'product_detail:{subproduct_id}'
+
+
+def build_product_detail(subproduct_id):
+    """The read model of one SubProduct, or None if it does not exist"""
+    subproduct = (SubProduct.objects.select_related('product__category')
+                  .prefetch_related('product_size_color__size', 'product_size_color__color')
+                  .filter(pk=subproduct_id).first())
+    if subproduct is None:
+        return None
+
+    product = subproduct.product
+    sizes, colors, matrix = {}, {}, {}
+    for row in subproduct.product_size_color.all():
+        sizes[row.size.id] = row.size.name
+        colors[row.color.id] = row.color.name
+        matrix.setdefault(row.size.name, {})
+        matrix[row.size.name][row.color.name] = matrix[row.size.name].get(row.color.name, 0) + row.stock_quantity
+
+    return {
+        'id': subproduct.id,
+        'product_id': product.id,
+        'description': subproduct.description,
+        'image_url': subproduct.image_url,
+        'updated_at': subproduct.updated_at,
+        'product': {
+            'id': product.id,
+            'name': product.name,
+            'price': product.price,
+            'category': {'id': product.category.id, 'name': product.category.name},
+        },
+        'sizes': [{'id': size_id, 'name': sizes[size_id]} for size_id in sorted(sizes)],
+        'colors': [{'id': color_id, 'name': colors[color_id]} for color_id in sorted(colors, key=colors.get)],
+        'stock': matrix,
+        'total_stock': sum(sum(by_color.values()) for by_color in matrix.values()),
+        'stock_etag': hashlib.md5(json.dumps(matrix, sort_keys=True).encode()).hexdigest(),
+    }
+
+
+def get_product_detail(subproduct_id):
+    """Cached build_product_detail(); None for unknown products (not cached)"""
+    key = _cache_key(subproduct_id)
+    detail = cache.get(key)
+    if detail is None:
+        detail = build_product_detail(subproduct_id)
+        if detail is not None:
+            cache.set(key, detail, settings.PRODUCT_DETAIL_CACHE_TTL)
+    return detail
+
+
+def invalidate_product_details(subproduct_ids):
+    cache.delete_many([_cache_key(subproduct_id) for subproduct_id in subproduct_ids])
+
+
+def _subproduct_changed(sender, instance, **kwargs):
+    invalidate_product_details([instance.id])
+
+
+def _product_changed(sender, instance, **kwargs):
+    invalidate_product_details(SubProduct.objects.filter(product=instance).values_list('id', flat=True))
+
+
+def _category_changed(sender, instance, **kwargs):
+    invalidate_product_details(SubProduct.objects.filter(product__category=instance).values_list('id', flat=True))
+
+
+def _stock_changed(sender, instance, **kwargs):
+    invalidate_product_details(instance.subproduct_set.values_list('id', flat=True))
+
+
+def _stock_rows_changed(sender, instance, action, pk_set=None, reverse=False, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_product_details([instance.id])
+    elif pk_set:
+        invalidate_product_details(pk_set)
+    else:
+        invalidate_product_details(instance.subproduct_set.values_list('id', flat=True))
+
+
+post_save.connect(_subproduct_changed, sender=SubProduct, dispatch_uid='product_detail_subproduct_saved')
+post_delete.connect(_subproduct_changed, sender=SubProduct, dispatch_uid='product_detail_subproduct_deleted')
+post_save.connect(_product_changed, sender=Product, dispatch_uid='product_detail_product_saved')
+post_save.connect(_category_changed, sender=Category, dispatch_uid='product_detail_category_saved')
+post_save.connect(_stock_changed, sender=ProductSizeNColor, dispatch_uid='product_detail_stock_saved')
+# pre_delete: the rows linking a stock row to its subproducts are already gone by post_delete
+pre_delete.connect(_stock_changed, sender=ProductSizeNColor, dispatch_uid='product_detail_stock_deleted')
+m2m_changed.connect(_stock_rows_changed, sender=SubProduct.product_size_color.through,
+                    dispatch_uid='product_detail_stock_rows')
@@ -0,0 +1,111 @@
+"""
+In-process cache of the small lookup tables: Size, Color, Category and
+stateModel.
+
+Each table is loaded once per process into a Table (rows in id order
+plus id and lower-cased name maps). A version token per table (see
+versions.py) is replaced whenever a row is saved or deleted; a process
+re-reads the token at most every REFERENCE_VERSION_CHECK seconds and
+reloads the table when it changed, so every worker sees edits without a
+restart. Tables are also reloaded after REFERENCE_TABLE_TTL seconds,
+which covers writes that send no signals (queryset.update(), raw SQL).
+
+The cached rows are shared between requests: read them, never modify them.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from admin_app.models import Category, Color, Size
+from .models import stateModel
+from .versions import bump_version, current_version
+
+_lock = threading.Lock()
+_tables = {}
+
+
+class Table:
+    def __init__(self, model, name_field, version):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.name_field = name_field
+        self.rows = list(model.objects.order_by('id'))
+        self.by_id = {row.id: row for row in self.rows}
+        self.by_name = {}
+        for row in self.rows:
+            name = getattr(row, name_field)
+            if name is not None:
+                self.by_name.setdefault(name.lower(), []).append(row)
+
+    def get(self, name):
+        """First row whose name matches `name` case-insensitively, or None"""
+        rows = self.by_name.get((name or '').lower())
+        return rows[0] if rows else None
+
+    def ids(self, name):
+        """Ids of every row called exactly `name` (names are not unique in these tables)"""
+        return [row.id for row in self.by_name.get((name or '').lower(), [])
+                if getattr(row, self.name_field) == name]
+
+    def name(self, row_id):
+        row = self.by_id.get(row_id)
+        return getattr(row, self.name_field) if row else None
+
+
+MODELS = {
+    'size': (Size, 'name'),
+    'color': (Color, 'name'),
+    'category': (Category, 'name'),
+    'state': (stateModel, 'state_name'),
+}
+
+
+def _version_key(table):
+    return f'reference:{table}'
+
+
+def _stale(current, version):
+    return (current is None or current.version != version
+            or time.monotonic() - current.loaded_at >= settings.REFERENCE_TABLE_TTL)
+
+
+def table(name):
+    """The current Table for 'size', 'color', 'category' or 'state'"""
+    version = current_version(_version_key(name), settings.REFERENCE_VERSION_CHECK)
+    current = _tables.get(name)
+    if _stale(current, version):
+        with _lock:
+            current = _tables.get(name)
+            if _stale(current, version):
+                model, name_field = MODELS[name]
+                current = _tables[name] = Table(model, name_field, version)
+    return current
+
+
+def sizes():
+    return table('size')
+
+
+def colors():
+    return table('color')
+
+
+def categories():
+    return table('category')
+
+
+def states():
+    return table('state')
+
+
+def _invalidate(table_name):
+    def receiver(**kwargs):
+        bump_version(_version_key(table_name))
+    return receiver
+
+
+for name, (model, _) in MODELS.items():
+    post_save.connect(_invalidate(name), sender=model, weak=False, dispatch_uid=f'reference_{name}_saved')
+    post_delete.connect(_invalidate(name), sender=model, weak=False, dispatch_uid=f'reference_{name}_deleted')
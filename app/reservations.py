@@ -0,0 +1,85 @@
+"""
+Short-lived stock reservations for shoppers in checkout.
+
+Opening checkout holds the cart's units for STOCK_RESERVATION_TTL
+seconds; opening it again adjusts the quantities but not the deadline of
+a hold that is still running. Every stock check (stock.stock_rows) then treats units reserved
+by other shoppers as unavailable, and placing the order turns the
+shopper's own reservations into real stock decrements
+(orders.place_cart_order). A reservation that runs out is simply ignored
+by those queries; release_expired_reservations() deletes such rows and is
+run by the release_reservations command.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import StockReservation
+from .stock import allocate, cart_triple, stock_rows
+
+logger = logging.getLogger(__name__)
+
+
+def reserve_cart(user, lines):
+    """
+    Hold the units of the cart `lines` for `user`, replacing the user's
+    earlier reservations. Rows the user already holds keep their expiry,
+    so revisiting checkout cannot stretch a hold. Returns {cart line id:
+    units reserved}; less than the line's quantity means other shoppers
+    hold the rest.
+
+    The stock rows stay locked only for the few statements of this call.
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    with transaction.atomic():
+        rows = stock_rows([cart_triple(line) for line in lines], for_update=True, exclude_user=user)
+        held = {}
+        reserved = {}
+        for line, row, quantity in allocate(lines, rows):
+            reserved[line.id] = quantity
+            if quantity > 0:
+                held[row.id] = held.get(row.id, 0) + quantity
+
+        current = StockReservation.objects.filter(user=user)
+        running = dict(current.filter(expires_at__gt=now).values_list('stock_id', 'expires_at'))
+        current.delete()
+        StockReservation.objects.bulk_create([
+            StockReservation(user=user, stock_id=row_id, quantity=quantity,
+                             expires_at=running.get(row_id, expires_at))
+            for row_id, quantity in held.items()
+        ])
+    return reserved
+
+
+def release_line(user, line):
+    """Give back the units `user` holds for one cart line, leaving the rest of the cart held"""
+    row = stock_rows([cart_triple(line)]).get(cart_triple(line))
+    if row is None:
+        return 0
+    with transaction.atomic():
+        reservation = StockReservation.objects.select_for_update().filter(user=user, stock=row).first()
+        if reservation is None:
+            return 0
+        released = min(reservation.quantity, line.quantity)
+        if released == reservation.quantity:
+            reservation.delete()
+        else:
+            reservation.quantity -= released
+            reservation.save(update_fields=['quantity'])
+    return released
+
+
+def release_reservations(user):
+    """Give back everything `user` holds"""
+    return StockReservation.objects.filter(user=user).delete()[0]
+
+
+def release_expired_reservations(now=None):
+    """Delete the reservations that have run out with a single DELETE"""
+    released = StockReservation.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
+    logger.info(f"Released {released} expired stock reservation(s)")
+    return released
@@ -0,0 +1,153 @@
+"""
+Full-text product search.
+
+SubProducts are searched on their product name, description and
+category name. Queries are split into word tokens, every token is
+matched as a prefix ("shi" finds "shirt") and all tokens must match;
+results come back best match first, with hits in the name weighted
+above the category and the description.
+
+Two backends, picked from the database vendor:
+
+* SQLite: an FTS5 inverted index (the app_product_search table, created
+  by migration 0009).
+* PostgreSQL: a stored, weighted tsvector per subproduct with a GIN index
+  (the app_product_search table, created by migration 0012), matched
+  with to_tsquery.
+
+Either index is kept in sync by the signal receivers below.
+
+Run the rebuild_search_index command after bulk imports that bypass
+model signals.
+"""
+import re
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+from admin_app.models import Category, Product, SubProduct
+
+SEARCH_TABLE = 'app_product_search'
+MAX_TOKENS = 8
+RESULTS_LIMIT = 1000
+
+
+def tokenize(query):
+    """Lower-cased word tokens of a search query"""
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TOKENS]
+
+
+class SqliteSearchBackend:
+    # bm25 column weights: name, description, category
+    WEIGHTS = (10.0, 1.0, 5.0)
+
+    def index(self, ids):
+        rows = SubProduct.objects.filter(id__in=ids).values_list(
+            'id', 'product__name', 'description', 'product__category__name')
+        with connection.cursor() as cursor:
+            self._delete(cursor, ids)
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, name, description, category) VALUES (%s, %s, %s, %s)',
+                list(rows))
+
+    def remove(self, ids):
+        with connection.cursor() as cursor:
+            self._delete(cursor, ids)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        self.index(SubProduct.objects.values_list('id', flat=True))
+
+    def search(self, tokens, limit):
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY bm25({SEARCH_TABLE}, %s, %s, %s) LIMIT %s',
+                [match, *self.WEIGHTS, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def _delete(self, cursor, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+
+class PostgresSearchBackend:
+    # name above category above description, as the A/B/C tsvector weights
+    DOCUMENT = ("setweight(to_tsvector(coalesce(p.name, '')), 'A') "
+                "|| setweight(to_tsvector(coalesce(c.name, '')), 'B') "
+                "|| setweight(to_tsvector(coalesce(s.description, '')), 'C')")
+
+    def index(self, ids):
+        self._upsert('WHERE s.id = ANY(%s)', [list(ids)])
+
+    def remove(self, ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE subproduct_id = ANY(%s)', [list(ids)])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        self._upsert('', [])
+
+    def search(self, tokens, limit):
+        match = ' & '.join(f'{token}:*' for token in tokens)
+        with connection.cursor() as cursor:
+            # @@ is answered by the GIN index; only the matching rows are ranked
+            cursor.execute(
+                f'SELECT subproduct_id FROM {SEARCH_TABLE}, to_tsquery(%s) query WHERE document @@ query '
+                f'ORDER BY ts_rank(document, query) DESC, subproduct_id LIMIT %s',
+                [match, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def _upsert(self, where, params):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {SEARCH_TABLE} (subproduct_id, document) SELECT s.id, {self.DOCUMENT} '
+                f'FROM admin_app_subproduct s JOIN admin_app_product p ON p.id = s.product_id '
+                f'JOIN admin_app_category c ON c.id = p.category_id {where} '
+                f'ON CONFLICT (subproduct_id) DO UPDATE SET document = EXCLUDED.document',
+                params)
+
+
+def get_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return SqliteSearchBackend()
+
+
+def search_products(query, limit=RESULTS_LIMIT):
+    """Ids of the SubProducts matching `query`, best match first"""
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    return get_backend().search(tokens, limit)
+
+
+def rebuild_search_index():
+    get_backend().rebuild()
+
+
+def _subproduct_saved(sender, instance, **kwargs):
+    get_backend().index([instance.id])
+
+
+def _subproduct_deleted(sender, instance, **kwargs):
+    get_backend().remove([instance.id])
+
+
+def _product_saved(sender, instance, **kwargs):
+    get_backend().index(SubProduct.objects.filter(product=instance).values_list('id', flat=True))
+
+
+def _category_saved(sender, instance, **kwargs):
+    get_backend().index(SubProduct.objects.filter(product__category=instance).values_list('id', flat=True))
+
+
+post_save.connect(_subproduct_saved, sender=SubProduct, dispatch_uid='search_subproduct_saved')
+post_delete.connect(_subproduct_deleted, sender=SubProduct, dispatch_uid='search_subproduct_deleted')
+post_save.connect(_product_saved, sender=Product, dispatch_uid='search_product_saved')
+post_save.connect(_category_saved, sender=Category, dispatch_uid='search_category_saved')
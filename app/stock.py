@@ -0,0 +1,101 @@
+"""
+Batched stock lookups.
+
+Cart lines and order lines name a variant by (subproduct id, size name,
+color name). stock_rows() resolves any number of those triples against
+the subproducts' ProductSizeNColor rows in a single query, and
+stock_levels() turns that into {triple: available quantity}. Triples
+with no matching variant are reported with 0 stock.
+
+Available means stock_quantity minus the units other shoppers hold in
+unexpired StockReservations (see reservations.py), summed in the same
+query.
+"""
+from functools import reduce
+from operator import or_
+
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from admin_app.models import ProductSizeNColor
+from .models import StockReservation
+from .reference import colors, sizes
+
+
+def _triples(lines):
+    return {(int(subproduct_id), size, color) for subproduct_id, size, color in lines if size and color}
+
+
+def _held(exclude_user):
+    """Units of the outer stock row held by unexpired reservations, other than `exclude_user`'s"""
+    reservations = StockReservation.objects.filter(stock=OuterRef('pk'), expires_at__gt=timezone.now())
+    if exclude_user is not None:
+        reservations = reservations.exclude(user=exclude_user)
+    return Coalesce(Subquery(reservations.order_by().values('stock').annotate(total=Sum('quantity')).values('total'),
+                             output_field=IntegerField()), 0)
+
+
+def stock_rows(lines, for_update=False, exclude_user=None):
+    """
+    {(subproduct_id, size, color): ProductSizeNColor} for the variants that
+    exist, each with .reserved (units held for other shoppers than
+    `exclude_user`) and .available. With `for_update` the rows are locked
+    until the end of the surrounding transaction.
+    """
+    size_table, color_table = sizes(), colors()
+    wanted = {}
+    for subproduct_id, size, color in _triples(lines):
+        # names resolve to ids from the reference cache, so no join on Size/Color
+        size_ids, color_ids = size_table.ids(size), color_table.ids(color)
+        if size_ids and color_ids:
+            wanted[(subproduct_id, size, color)] = (size_ids, color_ids)
+    if not wanted:
+        return {}
+
+    condition = reduce(or_, (Q(subproduct=subproduct_id, size_id__in=size_ids, color_id__in=color_ids)
+                             for (subproduct_id, _, _), (size_ids, color_ids) in wanted.items()))
+    variants = ProductSizeNColor.objects.filter(condition)
+    if for_update:
+        variants = variants.select_for_update(of=('self',))
+    rows = {}
+    for row in variants.annotate(subproduct_ref=F('subproduct'), reserved=_held(exclude_user)).order_by('id'):
+        row.available = max(row.stock_quantity - row.reserved, 0)
+        rows.setdefault((row.subproduct_ref, row.size_id, row.color_id), row)
+
+    found = {}
+    for triple, (size_ids, color_ids) in wanted.items():
+        matches = [rows[(triple[0], size_id, color_id)] for size_id in size_ids for color_id in color_ids
+                   if (triple[0], size_id, color_id) in rows]
+        if matches:
+            found[triple] = min(matches, key=lambda row: row.id)
+    return found
+
+
+def stock_levels(lines, exclude_user=None):
+    """{(subproduct_id, size, color): quantity available} for every requested triple"""
+    rows = stock_rows(lines, exclude_user=exclude_user)
+    return {triple: rows[triple].available if triple in rows else 0
+            for triple in _triples(lines)}
+
+
+def allocate(lines, rows):
+    """
+    (line, stock row, quantity) for every cart line of `lines`, given the
+    stock_rows() of their variants. Each line gets as much as is still
+    available after the lines before it.
+    """
+    left = {row.id: row.available for row in rows.values()}
+    allocations = []
+    for line in lines:
+        row = rows.get(cart_triple(line))
+        quantity = min(line.quantity, left[row.id]) if row else 0
+        if quantity > 0:
+            left[row.id] -= quantity
+        allocations.append((line, row, quantity))
+    return allocations
+
+
+def cart_triple(item):
+    """The stock key of a Cart line"""
+    return (item.subproduct_id, item.size, item.color)
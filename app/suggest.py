@@ -0,0 +1,107 @@
+"""
+In-memory typeahead index for the search box.
+
+Every word of every product and category name is a key in one sorted
+list, so the keys starting with a prefix are one contiguous range found
+with two bisects, and no query hits the database. The index is built
+lazily per process and rebuilt after a product, subproduct or category
+is saved or deleted in any worker: a version token (see versions.py),
+re-read at most every SUGGEST_VERSION_CHECK seconds, says when.
+"""
+import bisect
+import re
+import threading
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.urls import NoReverseMatch, reverse
+
+from admin_app.models import Category, Product, SubProduct
+from .versions import bump_version, current_version
+
+VERSION_CACHE_KEY = 'suggest_index_version'
+# sorts after every key that starts with a given prefix
+_KEY_END = chr(0x10ffff)
+
+_lock = threading.Lock()
+_index = None
+
+
+class PrefixIndex:
+    def __init__(self, entries, version=None):
+        """`entries` are dicts with at least a 'name'; every word of the name becomes a key"""
+        self.version = version
+        self.entries = entries
+        pairs = []
+        for position, entry in enumerate(entries):
+            words = re.findall(r'\w+', entry['name'].lower())
+            for start in range(len(words)):
+                # (key, which word the key starts at, entry position)
+                pairs.append((' '.join(words[start:]), start, position))
+        pairs.sort()
+        self.keys = [pair[0] for pair in pairs]
+        self.refs = [(pair[1], pair[2]) for pair in pairs]
+
+    def complete(self, prefix, limit=8):
+        """Up to `limit` entries with a word starting with `prefix`, names starting with it first"""
+        prefix = ' '.join(re.findall(r'\w+', prefix.lower()))
+        if not prefix:
+            return []
+        found = {}
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + _KEY_END, start)
+        for i in range(start, end):
+            word, position = self.refs[i]
+            if position not in found or word < found[position][0]:
+                found[position] = (word, self.keys[i])
+        ranked = sorted(found.items(), key=lambda item: (item[1][0], item[1][1]))
+        return [self.entries[position] for position, _ in ranked[:limit]]
+
+
+def _version():
+    return current_version(VERSION_CACHE_KEY, settings.SUGGEST_VERSION_CHECK)
+
+
+def _category_url(category):
+    try:
+        return reverse('section', args=[category.name])
+    except NoReverseMatch:
+        # names the section route cannot take (e.g. containing "/") link to a search instead
+        return reverse('search') + '?' + urlencode({'search_box': category.name})
+
+
+def build_index(version=None):
+    entries = [{'type': 'category', 'id': category.id, 'name': category.name,
+                'url': _category_url(category), 'thumbnail': None}
+               for category in Category.objects.all()]
+    entries += [{'type': 'product', 'id': product.id, 'name': product.product.name,
+                 'url': reverse('show_product', args=[product.id]), 'thumbnail': product.image_url}
+                for product in SubProduct.objects.select_related('product')]
+    return PrefixIndex(entries, version)
+
+
+def get_index():
+    """The current index, rebuilt first if the catalog changed since it was built"""
+    global _index
+    version = _version()
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = build_index(version)
+            index = _index
+    return index
+
+
+def suggest(prefix, limit=8):
+    return get_index().complete(prefix, limit)
+
+
+def invalidate_index(**kwargs):
+    bump_version(VERSION_CACHE_KEY)
+
+
+for model in (Category, Product, SubProduct):
+    post_save.connect(invalidate_index, sender=model, dispatch_uid='suggest_save_{}'.format(model.__name__))
+    post_delete.connect(invalidate_index, sender=model, dispatch_uid='suggest_delete_{}'.format(model.__name__))
@@ -1,3 +1,639 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import threading
+import time
+import warnings
+from urllib.parse import parse_qs, urlparse
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from admin_app.models import Category, Color, Product, ProductSizeNColor, Size, SubProduct
+from app import bestsellers, currency, facets, page_cache, reference, suggest, versions, visitors
+from app import orders
+from app.models import AddressModel, Cart, IdempotencyKey, StockReservation, User, placeOrder, stateModel, sub_placeorder
+from app.orders import OrderConflict, place_cart_order
+from app.carts import load_cart
+from app.pagination import paginate
+from app.reservations import reserve_cart
+from app.stock import stock_levels
+from app.views import filter_by_price, with_display_price
+from app.models import Visitor
+from src.payment.models import Payment
+from src.payment.views import to_cents
+
+
+class VisitorCounterTests(TestCase):
+    def setUp(self):
+        visitors.flush_visits()
+        self.addCleanup(visitors.flush_visits)
+
+    def test_threads_are_spread_over_the_shards(self):
+        shards = set()
+
+        def visit():
+            shards.add(id(visitors._shard()))
+
+        threads = [threading.Thread(target=visit) for _ in range(len(visitors._shards))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(shards), len(visitors._shards))
+
+    def test_failed_flush_keeps_the_hits(self):
+        with self.settings(VISITOR_FLUSH_HITS=1000, VISITOR_FLUSH_INTERVAL=3600):
+            visitors.record_visit()
+            visitors.record_visit()
+        with mock.patch.object(Visitor.objects, 'filter', side_effect=RuntimeError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                visitors.flush_visits()
+            # a visit that triggers the flush still succeeds
+            with self.settings(VISITOR_FLUSH_HITS=1):
+                visitors.record_visit()
+        self.assertEqual(visitors._pending(), 3)
+
+        self.assertEqual(visitors.flush_visits(), 3)
+        self.assertEqual(Visitor.objects.get(id=visitors.VISITOR_ID).count, 3)
+
+
+class CircuitBreakerTests(TestCase):
+    def test_opens_probes_once_and_closes(self):
+        breaker = currency.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with mock.patch('app.currency.time.monotonic', return_value=1000):
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, breaker.OPEN)
+            self.assertFalse(breaker.allow())
+        with mock.patch('app.currency.time.monotonic', return_value=1060):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            # only the one probe
+            self.assertFalse(breaker.allow())
+            breaker.record_success()
+        self.assertEqual((breaker.state, breaker.consecutive_failures), (breaker.CLOSED, 0))
+
+    def test_failed_probe_opens_again(self):
+        breaker = currency.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with mock.patch('app.currency.time.monotonic', return_value=1000):
+            breaker.record_failure()
+            breaker.record_failure()
+        with mock.patch('app.currency.time.monotonic', return_value=1060):
+            breaker.allow()
+            breaker.record_failure()
+            self.assertEqual(breaker.state, breaker.OPEN)
+            self.assertFalse(breaker.allow())
+
+
+class ExchangeRateServiceTests(TestCase):
+    def setUp(self):
+        self.service = currency.ExchangeRateService('key', currencies=('USD',), ttl=60)
+        recompute = mock.patch.object(self.service, '_recompute_prices')
+        recompute.start()
+        self.addCleanup(recompute.stop)
+
+    def test_prices_are_recomputed_once_per_rate_table(self):
+        cache.clear()
+        other = currency.ExchangeRateService('key', currencies=('USD',), ttl=60)
+        with mock.patch('app.currency.threading.Thread') as thread:
+            other._recompute_prices({'USD': 0.012})
+            currency.ExchangeRateService('key', currencies=('USD',), ttl=60)._recompute_prices({'USD': 0.012})
+            self.assertEqual(thread.call_count, 1)
+            other._recompute_prices({'USD': 0.013})
+            self.assertEqual(thread.call_count, 2)
+
+    def test_spent_budget_makes_no_call(self):
+        client = self.service.client
+        with mock.patch('app.currency.requests.request') as request, client.budget(0):
+            with self.assertRaises(currency.BudgetExceeded):
+                client.latest(base_currency='INR', currencies=['USD'])
+        request.assert_not_called()
+
+    def test_failed_fetches_back_off(self):
+        with mock.patch.object(self.service.client, 'latest',
+                               side_effect=[RuntimeError('down'), RuntimeError('down'), {'data': {'USD': 0.012}}]), \
+                mock.patch('app.currency.time.sleep') as sleep, \
+                self.settings(CURRENCY_RETRY_BACKOFF=0.5, CURRENCY_API_BUDGET=5):
+            self.assertEqual(self.service.refresh(), {'USD': 0.012})
+        first, second = (call.args[0] for call in sleep.call_args_list)
+        self.assertTrue(0.25 <= first <= 0.5 and 0.5 <= second <= 1)
+
+    def test_backoff_past_the_budget_gives_up(self):
+        with mock.patch.object(self.service.client, 'latest', side_effect=RuntimeError('down')) as latest, \
+                mock.patch('app.currency.time.sleep') as sleep, \
+                self.settings(CURRENCY_RETRY_BACKOFF=10, CURRENCY_API_BUDGET=5):
+            self.assertEqual(self.service.refresh(), {})
+        self.assertEqual(latest.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_stale_rates_are_served_while_revalidating(self):
+        self.service._rates = {'USD': 0.012}
+        self.service._fetched_at = time.monotonic() - 61
+        with mock.patch.object(self.service, '_refresh_in_background') as refresh:
+            self.assertEqual(self.service.get_rate('USD'), 0.012)
+        refresh.assert_called_once()
+
+        with mock.patch.object(self.service.client, 'latest', side_effect=RuntimeError('down')), \
+                mock.patch('app.currency.time.sleep'):
+            self.service.refresh()
+        self.assertEqual(self.service.get_rate('USD'), 0.012)
+
+
+class BestsellerTests(TestCase):
+    def test_cron_rebuild_is_what_the_homepage_reads(self):
+        category = Category.objects.create(name='Man')
+        product = Product.objects.create(name='Shirt', price=999, category=category)
+        subproduct = SubProduct.objects.create(product=product, description='shirt')
+        cache.clear()
+
+        call_command('rebuild_bestsellers', days=[30], stdout=io.StringIO())
+        with mock.patch.object(bestsellers, 'rebuild_bestsellers', side_effect=AssertionError('not cached')):
+            self.assertEqual(bestsellers.bestseller_ids(30), [subproduct.id])
+
+
+class DeliverOrdersTests(TestCase):
+    def test_due_orders_are_delivered(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        order = placeOrder.objects.create(order_status='Pending', delivery_date=yesterday)
+        out = io.StringIO()
+        call_command('deliver_orders', stdout=out)
+        self.assertEqual(out.getvalue(), '1 order(s) marked as Delivered\n')
+        self.assertEqual(placeOrder.objects.get(pk=order.pk).order_status, 'Delivered')
+
+    def test_loop_outlives_a_failed_run(self):
+        out = io.StringIO()
+        with mock.patch('app.management.commands.deliver_orders.deliver_due_orders',
+                        side_effect=[RuntimeError('database is locked'), 0]), \
+                mock.patch('app.management.base.time.sleep', side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('deliver_orders', loop=60, stdout=out)
+        self.assertEqual(out.getvalue(), '0 order(s) marked as Delivered\n')
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.renders = 0
+
+        @page_cache.cache_anonymous_page
+        def view(request):
+            self.renders += 1
+            return HttpResponse(f'render {self.renders}')
+        self.view = view
+
+    def get(self):
+        request = RequestFactory().get('/about/')
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        return self.view(request).content
+
+    def test_catalog_change_drops_cached_pages(self):
+        self.assertEqual(self.get(), b'render 1')
+        self.assertEqual(self.get(), b'render 1')
+
+        Product.objects.create(name='Shirt', price=999, category=Category.objects.create(name='Man'))
+        self.assertEqual(self.get(), b'render 2')
+
+    def test_every_invalidation_gets_a_new_version(self):
+        versions = {page_cache.catalog_version()}
+        for _ in range(3):
+            page_cache.invalidate_pages()
+            versions.add(page_cache.catalog_version())
+        self.assertEqual(len(versions), 4)
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['local'].clear()
+        self.category = Category.objects.create(name='Man')
+        self.product = Product.objects.create(name='Linen Shirt', price=999, category=self.category)
+        self.subproduct = SubProduct.objects.create(product=self.product, description='shirt')
+
+    def names(self, prefix):
+        return [entry['name'] for entry in suggest.suggest(prefix)]
+
+    def test_rename_elsewhere_rebuilds_the_index(self):
+        self.assertEqual(self.names('lin'), ['Linen Shirt'])
+        # what another worker's save leaves behind: only the shared version changes
+        Product.objects.filter(pk=self.product.pk).update(name='Cotton Shirt')
+        suggest.invalidate_index()
+        self.assertEqual(self.names('lin'), [])
+        self.assertEqual(self.names('cot'), ['Cotton Shirt'])
+
+    def test_keystrokes_between_checks_skip_the_shared_cache(self):
+        suggest.suggest('lin')
+        with mock.patch.object(versions.cache, 'get', side_effect=AssertionError('shared cache read')):
+            self.assertEqual(self.names('lin'), ['Linen Shirt'])
+
+    def test_every_match_of_a_short_prefix_is_ranked(self):
+        Category.objects.bulk_create([Category(name=f'Big Sale {i:03}') for i in range(250)])
+        Category.objects.create(name='Shirts')
+        self.assertEqual(self.names('s')[0], 'Shirts')
+
+    def test_category_name_with_slash_links_to_search(self):
+        Category.objects.create(name='Tops/Tees')
+        entry = suggest.suggest('tops')[0]
+        self.assertEqual(entry['url'], '/search/?search_box=Tops%2FTees')
+
+
+class PriceBandTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Man')
+        for price in (499, 500, 1099):
+            product = Product.objects.create(name=f'Shirt {price}', price=price, category=category)
+            SubProduct.objects.create(product=product, description='shirt')
+
+    def request(self, **params):
+        request = RequestFactory().get('/Man/', params)
+        request.session = SessionStore()
+        return request
+
+    def test_price_on_an_edge_is_counted_once(self):
+        request = self.request()
+        queryset = with_display_price(SubProduct.objects.all(), None)
+        bands = facets.facet_counts(request, queryset, queryset, facets.parse_filters(request))['price_bands']
+        self.assertEqual([band['count'] for band in bands[:2]], [1, 2])
+        self.assertEqual(sum(band['count'] for band in bands), 3)
+
+        band_request = self.request(min_price=500, below_price=1100)
+        self.assertEqual(filter_by_price(queryset, band_request).count(), 2)
+
+    def test_bands_follow_the_active_currency(self):
+        with self.settings(PRICE_BANDS=[0, 500, 1000]), mock.patch.object(currency, 'get_rate', return_value=0.012):
+            self.assertEqual(facets.price_bands('USD'), [(Decimal('0.00'), Decimal('6.00')),
+                                                         (Decimal('6.00'), Decimal('12.00')),
+                                                         (Decimal('12.00'), None)])
+        with mock.patch.object(currency, 'get_rate', return_value=None):
+            self.assertEqual(facets.price_bands('USD'), [])
+
+
+class KeysetPaginationTests(TestCase):
+    keys = ('-order_date', '-id')
+
+    def setUp(self):
+        today = datetime.date.today()
+        dates = [today, None, today, today - datetime.timedelta(days=1), None, today, None]
+        self.orders = [placeOrder.objects.create(order_date=date) for date in dates]
+        # what ORDER BY order_date DESC NULLS LAST, id DESC gives
+        self.expected = [order.id for order in sorted(
+            self.orders, key=lambda order: (order.order_date is None, -(order.order_date or today).toordinal(), -order.id))]
+
+    def page(self, url=''):
+        request = RequestFactory().get('/order_list/', {k: v[0] for k, v in parse_qs(urlparse(url).query).items()})
+        return paginate(placeOrder.objects.all(), request, keys=self.keys, per_page=2, nullable=('order_date',))
+
+    def test_forward_pages_cover_every_row_once(self):
+        seen, page = [], self.page()
+        pages = [page]
+        seen += [order.id for order in page]
+        while page.has_next:
+            page = self.page(page.next_url)
+            pages.append(page)
+            seen += [order.id for order in page]
+        self.assertEqual(seen, self.expected)
+        self.assertFalse(pages[0].has_prev)
+
+    def test_backward_pages_match_the_forward_ones(self):
+        forward = [self.page()]
+        while forward[-1].has_next:
+            forward.append(self.page(forward[-1].next_url))
+
+        page = forward[-1]
+        backward = [[order.id for order in page]]
+        with warnings.catch_warnings():
+            # nulls_last=False is deprecated and only falls back to the database's own NULL order
+            warnings.simplefilter('error')
+            while page.has_prev:
+                page = self.page(page.prev_url)
+                backward.append([order.id for order in page])
+        self.assertEqual(backward[::-1], [[order.id for order in p] for p in forward])
+
+    def test_tampered_cursor_starts_over(self):
+        self.assertEqual([order.id for order in self.page('?cursor=bogus')], self.expected[:2])
+
+
+class SectionCountTests(TestCase):
+    def test_product_count_is_the_category_total(self):
+        category = Category.objects.create(name='Man')
+        for i in range(3):
+            product = Product.objects.create(name=f'Shirt {i}', price=999, category=category)
+            SubProduct.objects.create(product=product, description='shirt')
+        response = self.client.get('/Man/', {'per_page': 2})
+        self.assertEqual(len(response.context['products']), 2)
+        self.assertEqual(response.context['product_length'], 3)
+
+
+class ReferenceTableTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['local'].clear()
+        reference._tables.clear()
+
+    def test_size_added_elsewhere_is_seen_after_the_check_interval(self):
+        self.assertIsNone(reference.sizes().get('XL'))
+        # another process: the row and a new shared version, but no signal in this one
+        Size.objects.bulk_create([Size(name='XL')])
+        cache.set(reference._version_key('size'), 'elsewhere', None)
+        self.assertIsNone(reference.sizes().get('XL'))
+        caches['local'].clear()
+        self.assertIsNotNone(reference.sizes().get('xl'))
+
+    def test_lookups_between_checks_skip_the_shared_cache(self):
+        reference.sizes()
+        with mock.patch.object(versions.cache, 'get', side_effect=AssertionError('shared cache read')):
+            reference.sizes()
+            reference.sizes()
+        Size.objects.create(name='XL')
+        self.assertIsNotNone(reference.sizes().get('XL'))
+
+    def test_unsignalled_writes_show_up_after_the_ttl(self):
+        Color.objects.create(name='Red')
+        self.assertEqual(reference.colors().ids('Red'), [Color.objects.get().id])
+        Color.objects.update(name='Crimson')
+        self.assertEqual(reference.colors().ids('Crimson'), [])
+        with self.settings(REFERENCE_TABLE_TTL=0):
+            self.assertEqual(reference.colors().ids('Crimson'), [Color.objects.get().id])
+
+
+class ShopTestCase(TestCase):
+    """One shirt in M/Red and M/Blue with `stock` units each, and a shopper with an address"""
+    stock = 5
+
+    def setUp(self):
+        cache.clear()
+        reference._tables.clear()
+        product = Product.objects.create(name='Shirt', price=1000, category=Category.objects.create(name='Man'))
+        self.subproduct = SubProduct.objects.create(product=product, description='shirt')
+        size = Size.objects.create(name='M')
+        self.rows = {}
+        for name in ('Red', 'Blue'):
+            row = ProductSizeNColor.objects.create(product=product, size=size, color=Color.objects.create(name=name),
+                                                   stock_quantity=self.stock)
+            self.subproduct.product_size_color.add(row)
+            self.rows[name] = row
+        self.user = self.shopper('shopper')
+        self.address = AddressModel.objects.create(first_name='a', last_name='b', user_id=self.user,
+                                                   state=stateModel.objects.create(state_name='GJ'))
+
+    def shopper(self, name):
+        return User.objects.create(name=name, user_name=name, user_email=f'{name}@example.com',
+                                   user_password=make_password('pw'))
+
+    def add(self, quantity, color='Red', user=None):
+        return Cart.objects.create(uname=user or self.user, subproduct=self.subproduct, quantity=quantity,
+                                   size='M', color=color)
+
+    def left(self, color='Red'):
+        return ProductSizeNColor.objects.get(pk=self.rows[color].pk).stock_quantity
+
+
+class PlaceCartOrderTests(ShopTestCase):
+    def test_partial_order_gets_what_is_in_stock(self):
+        self.add(3)
+        self.add(4)
+        order = place_cart_order(self.user, self.address)
+        self.assertEqual(list(sub_placeorder.objects.filter(order_id=order).values_list('quantity', flat=True)), [3, 2])
+        self.assertEqual(order.total_quantity, 5)
+        self.assertEqual(self.left(), 0)
+        self.assertFalse(Cart.objects.filter(uname=self.user).exists())
+
+    def test_nothing_in_stock_keeps_the_cart(self):
+        ProductSizeNColor.objects.update(stock_quantity=0)
+        self.add(1)
+        with self.assertRaises(OrderConflict):
+            place_cart_order(self.user, self.address)
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertEqual(Cart.objects.filter(uname=self.user).count(), 1)
+
+    def test_order_drops_only_the_pages_showing_what_it_sold(self):
+        other = SubProduct.objects.create(description='dress', product=Product.objects.create(
+            name='Dress', price=1000, category=Category.objects.create(name='Woman')))
+        request = RequestFactory().get('/about/')
+        request.session = SessionStore()
+        scopes = {'sold': page_cache.product_pages(self.subproduct.id), 'section': page_cache.section_pages('Man'),
+                  'other': page_cache.product_pages(other.id), 'other section': page_cache.section_pages('Woman'),
+                  'about': None}
+
+        def keys():
+            return {name: page_cache.page_key(request, scope) for name, scope in scopes.items()}
+
+        before = keys()
+        self.add(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            place_cart_order(self.user, self.address)
+        after = keys()
+        self.assertEqual({name for name in scopes if before[name] != after[name]}, {'sold', 'section'})
+
+    def test_line_without_size_or_color_is_refused(self):
+        Cart.objects.create(uname=self.user, subproduct=self.subproduct, quantity=1, size=None, color=None)
+        with self.assertRaises(OrderConflict):
+            place_cart_order(self.user, self.address)
+        self.assertEqual(self.left(), 5)
+
+    def test_paid_order_needs_every_unit(self):
+        self.add(6)
+        with self.assertRaises(OrderConflict):
+            place_cart_order(self.user, self.address, allow_partial=False)
+        self.assertEqual(self.left(), 5)
+
+    def test_stock_taken_meanwhile_rolls_everything_back(self):
+        self.add(2)
+        self.add(1, color='Blue')
+        stock_rows = orders.stock_rows
+
+        def racing(*args, **kwargs):
+            rows = stock_rows(*args, **kwargs)
+            # another checkout empties one row between the read and the UPDATE
+            ProductSizeNColor.objects.filter(pk=self.rows['Red'].pk).update(stock_quantity=1)
+            return rows
+
+        with mock.patch.object(orders, 'stock_rows', racing), self.assertRaises(OrderConflict):
+            place_cart_order(self.user, self.address)
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertEqual(self.left('Blue'), 5)
+        self.assertEqual(Cart.objects.filter(uname=self.user).count(), 2)
+
+
+class StripeSuccessTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        rate = mock.patch.object(currency, 'get_rate', return_value=0.012)
+        rate.start()
+        self.addCleanup(rate.stop)
+        session = self.client.session
+        session['user'] = self.user.id
+        session.save()
+        self.add(2)
+
+    def intent(self, user_id=None, intent_id='pi_1'):
+        return SimpleNamespace(id=intent_id, status='succeeded',
+                               amount=to_cents(load_cart(self.user, 'USD').grand_total_usd),
+                               metadata={'user_id': str(user_id or self.user.id)})
+
+    def post(self, intent, raw=False):
+        with mock.patch('stripe.PaymentIntent.retrieve', return_value=intent):
+            response = self.client.post('/payment-success-stripe/', json.dumps({'payment_intent_id': intent.id}),
+                                        content_type='application/json')
+        return response if raw else response.json()
+
+    def test_no_payment_starts_before_size_and_color_are_chosen(self):
+        Cart.objects.create(uname=self.user, subproduct=self.subproduct, quantity=1, size=None, color=None)
+        with mock.patch('stripe.PaymentIntent.create', side_effect=AssertionError('intent created')):
+            self.assertEqual(self.client.post('/create-stripe-payment-intent/').status_code, 400)
+        self.assertRedirects(self.client.get('/checkout/'), '/cart/', fetch_redirect_response=False)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_matching_payment_places_the_order(self):
+        response = self.post(self.intent())
+        self.assertTrue(response['success'])
+        payment = Payment.objects.get()
+        self.assertEqual((payment.status, payment.placed_order.order_id), ('COMPLETED', response['order_id']))
+
+    def test_amount_other_than_the_cart_total_is_refused(self):
+        intent = self.intent()
+        intent.amount -= 1
+        self.assertFalse(self.post(intent)['success'])
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertEqual(Payment.objects.get().status, 'REFUND_DUE')
+
+    def test_someone_elses_payment_is_refused(self):
+        other = self.shopper('other')
+        self.assertFalse(self.post(self.intent(user_id=other.id))['success'])
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+
+    def test_paid_order_out_of_stock_is_traceable(self):
+        Cart.objects.update(quantity=6)
+        intent = self.intent()
+        self.assertFalse(self.post(intent)['success'])
+        self.assertFalse(placeOrder.objects.exists())
+        payment = Payment.objects.get()
+        self.assertEqual((payment.status, payment.payment_id, payment.user), ('REFUND_DUE', 'pi_1', self.user))
+        self.assertEqual(payment.amount * 100, intent.amount)
+
+    def test_retry_replays_the_order(self):
+        intent = self.intent()
+        first = self.post(intent)
+        self.add(1)
+        retry = self.post(intent, raw=True)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['order_id'], first['order_id'])
+        self.assertEqual(placeOrder.objects.count(), 1)
+        self.assertEqual(Cart.objects.filter(uname=self.user).count(), 1)
+
+    def test_payment_finalizes_one_order_after_its_key_is_gone(self):
+        intent = self.intent()
+        first = self.post(intent)
+        IdempotencyKey.objects.all().delete()
+        self.add(2)
+        self.assertEqual(self.post(intent)['order_id'], first['order_id'])
+        self.assertEqual(placeOrder.objects.count(), 1)
+
+    def test_payment_used_by_another_shopper_is_refused(self):
+        Payment.objects.create(user=self.shopper('other'), amount=1, method='stripe', payment_id='pi_1', status='COMPLETED')
+        self.assertFalse(self.post(self.intent())['success'])
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertEqual(Cart.objects.filter(uname=self.user).count(), 1)
+
+
+class PaypalCaptureTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        rate = mock.patch.object(currency, 'get_rate', return_value=0.012)
+        rate.start()
+        self.addCleanup(rate.stop)
+        self.add(2)
+        self.total = load_cart(self.user, 'USD').grand_total_usd
+        session = self.client.session
+        session['user'] = self.user.id
+        session['pending_order'] = {'user_id': self.user.id, 'total_usd': float(self.total), 'method': 'paypal',
+                                    'payment_id': 'PP-1'}
+        session.save()
+
+    def capture(self, value):
+        paypal_order = {'status': 'COMPLETED', 'purchase_units': [{'amount': {'value': str(value)}}]}
+        with mock.patch('src.payment.views.verify_paypal_order', return_value=paypal_order):
+            return self.client.post('/capture-paypal-order/', json.dumps({'orderID': 'PP-1'}),
+                                    content_type='application/json').json()
+
+    def test_capture_of_the_cart_total_places_the_order(self):
+        self.assertTrue(self.capture(self.total)['success'])
+        self.assertEqual(Payment.objects.get().status, 'COMPLETED')
+
+    def test_lines_added_after_the_paypal_order_are_not_given_away(self):
+        self.add(1, color='Blue')
+        self.assertFalse(self.capture(self.total)['success'])
+        self.assertFalse(placeOrder.objects.exists())
+        self.assertEqual(Payment.objects.get().status, 'REFUND_DUE')
+        self.assertEqual(Cart.objects.filter(uname=self.user).count(), 2)
+
+
+class ReservationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        session = self.client.session
+        session['user'] = self.user.id
+        session.save()
+        self.red, self.blue = self.add(2), self.add(1, color='Blue')
+
+    def held(self):
+        return dict(StockReservation.objects.filter(user=self.user).values_list('stock__color__name', 'quantity'))
+
+    def test_other_shoppers_see_held_units_as_gone(self):
+        reserve_cart(self.user, [self.red, self.blue])
+        triple = (self.subproduct.id, 'M', 'Red')
+        self.assertEqual(stock_levels([triple], exclude_user=self.shopper('other'))[triple], 3)
+        self.assertEqual(stock_levels([triple], exclude_user=self.user)[triple], 5)
+
+    def test_revisiting_checkout_keeps_the_deadline(self):
+        reserve_cart(self.user, [self.red])
+        soon = timezone.now() + datetime.timedelta(seconds=30)
+        StockReservation.objects.update(expires_at=soon)
+        self.red.quantity = 3
+        reserve_cart(self.user, [self.red, self.blue])
+        self.assertEqual(self.held(), {'Red': 3, 'Blue': 1})
+        self.assertEqual(StockReservation.objects.get(stock=self.rows['Red']).expires_at, soon)
+        self.assertGreater(StockReservation.objects.get(stock=self.rows['Blue']).expires_at, soon)
+
+    def test_lapsed_hold_starts_over(self):
+        reserve_cart(self.user, [self.red])
+        StockReservation.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        reserve_cart(self.user, [self.red])
+        self.assertGreater(StockReservation.objects.get().expires_at, timezone.now())
+
+    def test_removing_a_line_releases_only_its_units(self):
+        reserve_cart(self.user, [self.red, self.blue])
+        self.client.get(f'/removecart/{self.red.id}')
+        self.assertFalse(Cart.objects.filter(pk=self.red.pk).exists())
+        self.assertEqual(self.held(), {'Blue': 1})
+
+    def test_cannot_remove_someone_elses_line(self):
+        line = self.add(1, user=self.shopper('other'))
+        self.assertEqual(self.client.get(f'/removecart/{line.id}').status_code, 404)
+        self.assertTrue(Cart.objects.filter(pk=line.pk).exists())
+
+
+class PlaceOrderReplayTests(ShopTestCase):
+    def test_same_key_places_one_order(self):
+        session = self.client.session
+        session['user'] = self.user.id
+        session.save()
+        self.add(1)
+        first = self.client.post('/placeorder/', HTTP_IDEMPOTENCY_KEY='k1')
+        self.add(1)
+        retry = self.client.post('/placeorder/', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual((retry.status_code, retry['Location']), (first.status_code, first['Location']))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(placeOrder.objects.count(), 1)
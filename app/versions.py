@@ -0,0 +1,39 @@
+"""
+Version tokens for data each process builds for itself (lookup tables,
+the typeahead index) or stores under versioned keys (cached pages).
+
+The token for a key lives in the shared cache and is replaced by
+bump_version() whenever the underlying rows change. It is a fresh random
+token rather than a counter bumped with incr(), because not every cache
+backend increments atomically and two concurrent bumps must never end
+up on the same value.
+
+current_version() remembers the token in the process-local cache for
+`check_every` seconds, so hot paths read the shared cache at most once
+per interval; a bump made in this process is seen at once, one made in
+another process within `check_every` seconds.
+"""
+import uuid
+
+from django.core.cache import cache, caches
+
+local_cache = caches['local']
+
+
+def current_version(key, check_every=0):
+    """The token for `key`, read from the shared cache at most every `check_every` seconds"""
+    version = local_cache.get(key) if check_every else None
+    if version is None:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        if check_every:
+            local_cache.set(key, version, check_every)
+    return version
+
+
+def bump_version(key):
+    """Give `key` a new token, making everything built or stored under the old one stale"""
+    cache.set(key, uuid.uuid4().hex, None)
+    local_cache.delete(key)
@@ -1,27 +1,51 @@
 
 import datetime
+import json
+import logging
 import re
+import uuid
+from decimal import Decimal
 
 from django.contrib import messages
 from django.contrib.auth import authenticate, login as auth_login
 from django.contrib.auth import logout
 from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User as DjangoUser
-from django.db.models import F
+from django.core.exceptions import ValidationError
+from django.db.models import F, OuterRef, Subquery
 # from xhtml2pdf import pisa
-from django.db.models import Sum
+from django.db.models import Avg, Count
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 from admin_app.models import *
 # from admin_app.views import section
-from app.currency import INRToUSDConverter
+from app.currency import CENTS, active_currency, convert_many, historical_rates, is_foreign
 from app.models import *
+from .bestsellers import bestseller_ids
+from .carts import load_cart
+from .facets import facet_counts, filter_variants, parse_filters
+from .idempotency import idempotent
+from .middleware import get_user_context
+from .orders import OrderConflict, place_cart_order
+from .page_cache import cache_anonymous_page, product_pages, section_pages
+from .pagination import paginate, paginate_sequence
+from . import reference
+from .product_detail import get_product_detail
+from .reservations import release_line, reserve_cart
+from .search import search_products
+from .stock import cart_triple, stock_levels
+from .suggest import suggest
+from .visitors import record_visit, visitor_count
 from .utils import encode_id, decode_id
 
+logger = logging.getLogger(__name__)
+
 
 def custom_page_not_found(request, exception):
     return render(request, '404.html', status=404)
@@ -32,24 +56,8 @@ def custom_page_not_found(request, exception):
  Chcek user is login or not
 """
 def check_user(request):
-    try:
-        user = request.session.get('user')
-        user = User.objects.get(pk=user)
-        cart_items = Cart.objects.filter(uname=user)
-        firstname = user.name.split(' ')[0]
-        lastname = user.name.split(' ')[1]
-        visitor = Visitor.objects.first()
-        count = visitor.count if visitor else 0
-                        
-        context = { 'user':user, 'total_items':len(cart_items), 'firstname':firstname, 'lastname':lastname, 'visitor':count }
-    except:
-        visitor = Visitor.objects.first()
-        count = visitor.count if visitor else 0
-        
-        context = {
-            'visitor':count
-        }
-    return context
+    # computed once per request by UserContextMiddleware, copied so views can extend it
+    return dict(get_user_context(request))
 
 
 # ===============================================================================================================
@@ -60,18 +68,36 @@ def check_user(request):
     Search    
 """
 
-def new_product():
-    products = SubProduct.objects.order_by('-created_at')[:5]
+def new_product(currency_type=None):
+    products = with_display_price(SubProduct.objects.order_by('-created_at'), currency_type)[:5]
     return products
 
 
-def most_buy_product():
-    products = SubProduct.objects.annotate(
-        total_quantity=Sum('sub_placeorder__quantity')
-    ).order_by('-total_quantity')[:10]
-    return products
+def most_buy_product(currency_type=None):
+    ids = bestseller_ids(settings.BESTSELLER_WINDOW_DAYS)
+    products = with_display_price(SubProduct.objects.filter(id__in=ids), currency_type)
+    return sorted(products, key=lambda product: ids.index(product.id))
+
+def rating_summaries(products):
+    """{product id: {'avg_rating', 'review_count'}} for all `products` with a single GROUP BY query"""
+    summaries = {product.id: {'avg_rating': 0, 'review_count': 0} for product in products}
+    rows = Review.objects.filter(product__in=summaries.keys()).order_by().values('product').annotate(
+        avg_rating=Avg('rating'), review_count=Count('id'))
+    for row in rows:
+        summaries[row['product']] = {
+            'avg_rating': round(row['avg_rating'] or 0, 1),
+            'review_count': row['review_count'],
+        }
+    return summaries
 
 def home(request):
+    # counted before the page cache so cached hits are still visits
+    record_visit()
+    return home_page(request)
+
+
+@cache_anonymous_page
+def home_page(request):
     # User.objects.all().delete()
     # print('asd')
 
@@ -79,53 +105,23 @@ def home(request):
     today = datetime.date.today()
     last_week = today - datetime.timedelta(days=30)
     new_arrival = SubProduct.objects.filter(created_at__gte=last_week)
-    new_arrival = new_product()
-    most_buy = most_buy_product()
+    new_arrival = new_product(request.session.get('currency'))
+    most_buy = most_buy_product(request.session.get('currency'))
     currency(new_arrival,request.session.get('currency'))
     currency(most_buy,request.session.get('currency'))
     # print(new_arrival)
-    
-    order_status = placeOrder.objects.filter(order_status='Pending', delivery_date__lt=today)
-    for order in order_status:
-        order.order_status = 'Delivered'
-        order.save()
 
     
-    visitor, created = Visitor.objects.get_or_create(id=1)
-    visitor.count += 1
-    visitor.save()
-
-
-    count = visitor.count
+    count = visitor_count()
     # print(count)
     
 
 
 
-    # Get reviews for products on homepage
-    from django.db.models import Avg
-
-    # Create dictionaries for quick lookup
-    new_arrival_reviews_dict = {}
-    for product in new_arrival:
-        reviews = Review.objects.filter(product=product)
-        avg_rating = reviews.aggregate(Avg('rating'))['rating__avg'] or 0
-        review_count = reviews.count()
-        new_arrival_reviews_dict[product.id] = {
-            'avg_rating': round(avg_rating, 1),
-            'review_count': review_count,
-        }
-    
-    # Create dictionaries for quick lookup
-    most_buy_reviews_dict = {}
-    for product in most_buy:
-        reviews = Review.objects.filter(product=product)
-        avg_rating = reviews.aggregate(Avg('rating'))['rating__avg'] or 0
-        review_count = reviews.count()
-        most_buy_reviews_dict[product.id] = {
-            'avg_rating': round(avg_rating, 1),
-            'review_count': review_count,
-        }
+    # Rating summaries for both product grids from one grouped query
+    reviews_dict = rating_summaries(list(new_arrival) + list(most_buy))
+    new_arrival_reviews_dict = {product.id: reviews_dict[product.id] for product in new_arrival}
+    most_buy_reviews_dict = {product.id: reviews_dict[product.id] for product in most_buy}
     
     context = { **user_info,
                 'new_arrival':new_arrival, 
@@ -143,13 +139,34 @@ def search(request):
     if request.method == 'GET':
         search_query = request.GET.get('search_box')
         if search_query:
-            temp_ = SubProduct.objects.filter(product__name__icontains=search_query) | SubProduct.objects.filter(description__icontains=search_query) | SubProduct.objects.filter(product__category__name__icontains=search_query)
+            ids = search_products(search_query)
+            temp_ = with_display_price(SubProduct.objects.filter(id__in=ids), request.session.get('currency'))
+            if request.GET.get('sort'):
+                page = paginate_products(sort_by_price(temp_, request), request)
+                temp_ = page.items
+            else:
+                # best match first: page through the ranked ids, then load just that page
+                if request.GET.get('min_price') or request.GET.get('max_price') or request.GET.get('below_price'):
+                    matching = set(filter_by_price(temp_, request).values_list('id', flat=True))
+                    ids = [product_id for product_id in ids if product_id in matching]
+                page = paginate_sequence(ids, request)
+                rank = {product_id: position for position, product_id in enumerate(page.items)}
+                temp_ = sorted(temp_.filter(id__in=page.items), key=lambda product: rank[product.id])
             
             # print("       hhsh",temp_)
             currency(temp_,request.session.get('currency'))
-            context  = {'products':temp_, **user_info, 'search_query':search_query}
+            context  = {'products':temp_, **user_info, 'search_query':search_query, 'page':page}
             return render(request, 'search.html', context)
         
+
+def search_suggest(request):
+    """Typeahead for the search box: ?q=<prefix> -> matching products and categories as JSON"""
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 8)), 20))
+    except ValueError:
+        limit = 8
+    return JsonResponse({'results': suggest(request.GET.get('q', ''), limit)})
+
 # ===============================================================================================================
 
 """
@@ -341,6 +358,7 @@ def get_product_reviews(request, product_id):
         return JsonResponse({'success': False, 'message': f'Error getting reviews: {str(e)}'})
 
 
+@cache_anonymous_page
 def about(request):
     context = check_user(request)
     return render(request, 'about.html', context)
@@ -348,29 +366,93 @@ def about(request):
 # ===============================================================================================================
 
 """
-                                Currency Convertor for convert INR to USD
+                                Currency Convertor for convert INR to the active currency
                                 using API real time update
 s"""
 
-def currency(temp_,currency_type):
-    
-    currency_converter = INRToUSDConverter(api_key='fca_live_YmDDOQ53V2ORAoTPnzY4M8vJOBhlmqbFi6NNmUBp')
-    # currency_type = request.session.get('currency')
-    print('currency_type = ',currency_type)  
+def with_display_price(queryset, currency_type):
+    """
+    Annotate SubProducts with `display_price`, the price in the active
+    currency read from the materialized ProductPrice table, so listings
+    can sort and filter on it in SQL.
+    """
+    if is_foreign(currency_type):
+        return queryset.annotate(display_price=Subquery(
+            ProductPrice.objects.filter(product=OuterRef('product'), currency=active_currency(currency_type)).values('amount')[:1]
+        ))
+    return queryset.annotate(display_price=F('product__price'))
+
+
+def filter_by_price(queryset, request):
+    """Apply ?min_price=, ?max_price= and the exclusive ?below_price= (price bands) to a with_display_price() queryset"""
     try:
-        if not currency_type:
-            currency_type = ''
-            # request.session['currency'] = currency_type
+        if request.GET.get('min_price'):
+            queryset = queryset.filter(display_price__gte=request.GET['min_price'])
+        if request.GET.get('max_price'):
+            queryset = queryset.filter(display_price__lte=request.GET['max_price'])
+        if request.GET.get('below_price'):
+            queryset = queryset.filter(display_price__lt=request.GET['below_price'])
+    except (ValueError, ValidationError):
+        pass
+    return queryset
+
+
+def sort_by_price(queryset, request):
+    """Apply ?min_price=, ?max_price= and ?sort=price_asc|price_desc|newest to a with_display_price() queryset"""
+    queryset = filter_by_price(queryset, request)
+
+    sort = request.GET.get('sort')
+    if sort == 'price_asc':
+        queryset = queryset.order_by(F('display_price').asc(nulls_last=True), 'id')
+    elif sort == 'price_desc':
+        queryset = queryset.order_by(F('display_price').desc(nulls_last=True), 'id')
+    elif sort == 'newest':
+        queryset = queryset.order_by('-created_at')
+    return queryset
+
+
+def paginate_products(queryset, request):
+    """One keyset page of a sort_by_price() queryset, in the order its ?sort= asks for (newest by default)"""
+    sort = request.GET.get('sort')
+    if sort == 'price_asc':
+        return paginate(queryset, request, keys=('display_price', 'id'), nullable=('display_price',))
+    if sort == 'price_desc':
+        return paginate(queryset, request, keys=('-display_price', 'id'), nullable=('display_price',))
+    return paginate(queryset, request)
+
+
+def currency(temp_, currency_type, kind='product'):
+    """
+    Set display prices on a whole collection with one convert_many() call.
+
+    kind='product' -> SubProducts, sets product.price_usd
+    kind='order'   -> sub_placeorder lines, sets price_usd using the stored
+                      rate of the order date (no live API call)
+    """
+    items = list(temp_)
+    rates = None
+    if kind == 'order':
+        prices = [item.price for item in items]
+        if is_foreign(currency_type):
+            dates = [item.order_id.order_date if item.order_id else None for item in items]
+            rates_by_date = historical_rates(dates, active_currency(currency_type))
+            rates = [rates_by_date.get(date) for date in dates]
+    else:
+        prices = [item.product.price for item in items]
 
-        if 'USD' in currency_type:
-            for product in temp_:
-                product.product.price_usd = currency_converter.convert_inr_to_usd(product.product.price)
+    if kind == 'product' and all(getattr(item, 'display_price', None) is not None for item in items):
+        # already priced in SQL by with_display_price()
+        converted = [item.display_price.quantize(CENTS) if isinstance(item.display_price, Decimal) else item.display_price
+                     for item in items]
+    else:
+        converted = convert_many(prices, currency_type, rates=rates)
 
+    for item, price in zip(items, converted):
+        if kind == 'order':
+            item.price_usd = price
         else:
-            for product in temp_:
-                product.product.price_usd = product.product.price
-    except Exception as e:
-        print(e)
+            item.product.price_usd = price
+    return items
 
 # ===============================================================================================================
 
@@ -387,66 +469,57 @@ according product id display product details
 """
 
 
+@cache_anonymous_page(scope=section_pages)
 def section(request, cate):
     user_info = check_user(request)
     # print(user_info)
     # print(request.session['user'])
-    try:
-        category_obj = get_object_or_404(Category,name__iexact=cate)     
-    except:
+    category_obj = reference.categories().get(cate)
+    if category_obj is None:
         return render(request, '404.html', status=404)
     # print(category_obj)
     
-    temp_ = SubProduct.objects.filter(product__category=category_obj)
+    temp_ = with_display_price(SubProduct.objects.filter(product__category=category_obj).select_related('product__category'), request.session.get('currency'))
+    filters = parse_filters(request)
+    facets = facet_counts(request, temp_, filter_by_price(temp_, request), filters)
+    products = sort_by_price(filter_variants(temp_, **filters), request)
+    # the category total, not just this page
+    product_length = products.count()
+    page = paginate_products(products, request)
+    temp_ = page.items
     # print(temp_)
-    product_length = len(temp_)
 
     currency(temp_,request.session.get('currency'))
 
     context  = {'products':temp_, 
                  'category':category_obj,
                    **user_info,
-                   'product_length':product_length
+                   'product_length':product_length,
+                   'facets':facets,
+                   'page':page,
                    }
     return render(request, 'man.html', context)
 
 
 
+@cache_anonymous_page(scope=product_pages)
 def show_product(request, id):
     user_info = check_user(request)
-    product_obj = SubProduct.objects.get(pk=id)
-    # for debuging
-    # print(product_obj.product_size_color.all())
-    
-    product_obj_size = product_obj.product_size_color.all()
-    
-    unique_sizes = set()
-    for item in product_obj_size:
-        unique_sizes.add(item.size)
-    
-    size_for_product = list(unique_sizes)
-
-    unique_colors = set()
-    for item in product_obj_size:
-        unique_colors.add(item.color)
-    color_for_product = list(unique_colors)
-
-    
+    product_obj = get_product_detail(id)
+    if product_obj is None:
+        return render(request, '404.html', status=404)
 
     if user_info.get('user'):
-        check_item_in_cart = Cart.objects.filter(uname=user_info['user'], subproduct=product_obj)
-        
-        if check_item_in_cart:
-            product_obj.in_cart = True
-        else:
-            product_obj.in_cart = False
+        check_item_in_cart = Cart.objects.filter(uname=user_info['user'], subproduct_id=id).exists()
     else:
          check_item_in_cart = None
+    product_obj['in_cart'] = bool(check_item_in_cart)
 
-    currency([product_obj],request.session.get('currency'))
+    # the read model is cached in the base currency; convert per request
+    product_obj['product']['price_usd'] = convert_many([product_obj['product']['price']], request.session.get('currency'))[0]
     context  = {'product':product_obj,
-                 'sizes':size_for_product , 
-                'colors':color_for_product,
+                 'sizes':product_obj['sizes'] , 
+                'colors':product_obj['colors'],
                  **user_info, 
                  'check_item_in_cart':check_item_in_cart }
     return render(request, 'show_product.html', context)
@@ -472,13 +545,10 @@ def get_available_colors(request):
     product_id = request.POST.get('product_id')
     selected_size = request.POST.get('selected_size')
     
-    product = Product.objects.get(id=product_id)
     print("Product ID:", product_id)  # Add this line for debugging
-    product_size_colors = ProductSizeNColor.objects.filter(product=product, size__name=selected_size)
+    colors = ProductSizeNColor.objects.filter(product_id=product_id, size__name=selected_size).values('color__id', 'color__name')
     
-    data =[]
-    for item in product_size_colors:
-        data.append({'id':item.color.id, 'name':item.color.name})
+    data = [{'id': item['color__id'], 'name': item['color__name']} for item in colors]
     
     a = {'list':data}
 
@@ -490,24 +560,55 @@ def check_stock_quantity(request):
     selected_size = request.POST.get('selected_size')
     selected_color = request.POST.get('selected_color')
 
-    product_size_color = ProductSizeNColor.objects.filter(product_id=product_id, size__name=selected_size, color__name=selected_color).first()
-
-    stock_quantity = product_size_color.stock_quantity
-
-    return JsonResponse({'stock_quantity': stock_quantity})
+    stock_quantity = ProductSizeNColor.objects.filter(
+        product_id=product_id, size__name=selected_size, color__name=selected_color
+    ).values_list('stock_quantity', flat=True).first()
+
+    return JsonResponse({'stock_quantity': stock_quantity or 0})
+
+
+@cache_control(max_age=0, must_revalidate=True)
+@condition(etag_func=lambda request, id: (get_product_detail(id) or {}).get('stock_etag'))
+def product_stock(request, id):
+    """Size -> color -> stock matrix of a SubProduct as JSON; clients revalidate with If-None-Match"""
+    product = get_product_detail(id)
+    if product is None:
+        return JsonResponse({'error': 'Product not found'}, status=404)
+    return JsonResponse({
+        'product_id': product['id'],
+        'sizes': [size['name'] for size in product['sizes']],
+        'colors': [color['name'] for color in product['colors']],
+        'stock': product['stock'],
+    })
 
 
-def check_stock(subproduct_id, selected_size, selected_color):
-    variants = ProductSizeNColor.objects.filter(
-        product=subproduct_id,
-        size__name=selected_size,
-        color__name=selected_color
-    )
+def check_stock(subproduct_id, selected_size, selected_color, user=None):
+    return stock_levels([(subproduct_id, selected_size, selected_color)], exclude_user=user).get(
+        (int(subproduct_id), selected_size, selected_color), 0)
 
-    if not variants.exists():
-        return 0  # no stock
 
-    return variants.first().stock_quantity
+@csrf_exempt
+def check_stock_batch(request):
+    """
+    Stock of many variants in one query. POST JSON
+    {"items": [{"subproduct_id": 1, "size": "M", "color": "Red"}, ...]}
+    and get the same items back with "available" filled in.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        items = json.loads(request.body or b'{}').get('items', [])[:settings.STOCK_BATCH_MAX]
+        lines = [(int(item['subproduct_id']), item.get('size'), item.get('color')) for item in items]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+
+    # a shopper's own checkout reservations count as available to them
+    levels = stock_levels(lines, exclude_user=request.session.get('user'))
+    return JsonResponse({'items': [
+        {'subproduct_id': subproduct_id, 'size': size, 'color': color,
+         'available': levels.get((subproduct_id, size, color), 0)}
+        for subproduct_id, size, color in lines
+    ]})
 
 # ===============================================================================================================
 
@@ -544,7 +645,7 @@ def addcart(request, id):
                     
                     # Check stock quantity
                     try:
-                        stock_quantity = check_stock(product_id, cart_size, cart_color)
+                        stock_quantity = check_stock(subproduct_id, cart_size, cart_color, user=user)
                         print(f'Stock Quantity: {stock_quantity}')
                     except Exception as e:
                         print(f'Error checking stock: {str(e)}')
@@ -625,52 +726,12 @@ def addcart(request, id):
 def removecart(request,id):
     if 'user' not in request.session:
         return redirect('login')
-    item = Cart.objects.get(pk=id)
+    item = get_object_or_404(Cart, pk=id, uname=request.session['user'])
     item.delete()
+    # the line's reserved units go back on sale, the rest of the cart stays held
+    release_line(item.uname_id, item)
     return redirect('cart')
 
-def currancy_cart(temp_,currency_type):
-    currency_converter = INRToUSDConverter(api_key='fca_live_YmDDOQ53V2ORAoTPnzY4M8vJOBhlmqbFi6NNmUBp')
-    print('currency_type = ', currency_type)
-
-    try:
-        if not currency_type:
-            currency_type = ''
-            # request.session['currency'] = currency_type
-
-        if 'USD' in currency_type:
-            for product__ in temp_:
-                # Initialize total_price_usd to None first
-                product__.total_price_usd = None
-                # Try to convert price to USD
-                price_usd = currency_converter.convert_inr_to_usd(product__.subproduct.product.price)
-                if price_usd is not None:
-                    product__.subproduct.product.price_usd = price_usd
-                    product__.total_price_usd = product__.quantity * price_usd
-                else:
-                    # If conversion fails, set price_usd to None and keep total_price_usd as None
-                    product__.subproduct.product.price_usd = None
-                    product__.total_price_usd = None
-                # Clear the total_price field when using USD
-                product__.total_price = None
-        else:
-            for product__ in temp_:
-                product__.subproduct.product.price_usd = product__.subproduct.product.price 
-                # Clear the total_price_usd field when using INR
-                product__.total_price_usd = None
-                product__.total_price = product__.quantity * product__.subproduct.product.price
-
-
-    except Exception as e:
-        print(e)
-        # Ensure total_price_usd is set even if exception occurs
-        for product__ in temp_:
-            if not hasattr(product__, 'total_price_usd'):
-                product__.total_price_usd = None
-            if not hasattr(product__, 'total_price'):
-                product__.total_price = product__.quantity * product__.subproduct.product.price
-
-
 def cart(request):
     if 'user' not in request.session:
         return redirect('login')
@@ -685,62 +746,26 @@ def cart(request):
     user = user_info['user']  # Use the user from user_info instead of fetching again
     # product_obj = SubProduct.objects.get(pk=user_info['user'].id)
 
-    # Get all cart items for this user
-    cart_obj = Cart.objects.filter(uname=user).order_by('-created_at')
-    
-    # Debug output
-    print(f"Cart view - User ID: {user.id}, User name: {user.user_name}")
-    print(f"Cart view - Total cart items found: {cart_obj.count()}")
-    if cart_obj.exists():
-        for item in cart_obj:
-            print(f"  - Cart ID: {item.id}, Product: {item.subproduct.id}, Size: {item.size}, Color: {item.color}, Qty: {item.quantity}")
-    
+    # Get all cart items for this user: lines, prices and size/color options in two queries
+    cart_obj = load_cart(user, request.session.get('currency'), with_options=True)
 
-    
-    # product_obj = SubProduct.objects.get(pk=user_info['user'].id)
-    # sizes = product_obj.sizes.all()
 
-    currancy_cart(cart_obj,request.session.get('currency'))
-    
-    currency_type = request.session.get('currency', '')
-    
+    levels = stock_levels([cart_triple(item) for item in cart_obj], exclude_user=user)
     for item in cart_obj:
-        item.sizes = set(item.subproduct.product_size_color.values_list('size__name', flat=True))
-        item.colors = set(item.subproduct.product_size_color.values_list('color__name', flat=True))
-        # Only recalculate total_price if not using USD (to avoid overwriting)
-        if 'USD' not in currency_type:
-            item.total_price = item.quantity * item.subproduct.product.price
-        # Ensure total_price_usd is always set (even if None)
-        if not hasattr(item, 'total_price_usd'):
-            item.total_price_usd = None
-        # Ensure total_price is always set (even if None)
-        if not hasattr(item, 'total_price'):
-            item.total_price = item.quantity * item.subproduct.product.price
-    
-    
-    
-    total_cart_price = sum([item.total_price for item in cart_obj if item.total_price is not None])
-    total_cart_price_usd = sum([getattr(item, 'total_price_usd', None) or 0 for item in cart_obj if getattr(item, 'total_price_usd', None) is not None])
-
-    shipping_price = 50
-    shipping_price_usd = 1
-
-    after_shipping_price = total_cart_price + shipping_price
-    after_shipping_price_usd = total_cart_price_usd + shipping_price_usd
-    
-    sizes = Size.objects.all()
+        item.available = levels.get(cart_triple(item))
+        item.in_stock = item.available is None or item.quantity <= item.available
     
     context = {
-        'users': cart_obj,
+        'users': cart_obj.lines,
         **user_info,
-        'total_cart_price': total_cart_price,
-        'after_shipping_price': after_shipping_price,
+        'total_cart_price': cart_obj.total,
+        'after_shipping_price': cart_obj.grand_total,
         'number_of_items': len(cart_obj),
-        'total_cart_price_usd': total_cart_price_usd,
-        'after_shipping_price_usd': after_shipping_price_usd,
-        'shipping_price_usd': shipping_price_usd,
-        'shipping_price': shipping_price,
-        'sizes': sizes
+        'total_cart_price_usd': cart_obj.total_display,
+        'after_shipping_price_usd': cart_obj.grand_total_display,
+        'shipping_price_usd': cart_obj.shipping_display,
+        'shipping_price': cart_obj.shipping,
+        'sizes': reference.sizes().rows
     }
     return render(request, 'cart.html', context)
 
@@ -752,12 +777,8 @@ def get_colors(request):
 
         print(f'Product ID: {product_id}, Size: {size}')
         
-        # Query the database to get colors based on the selected size and product ID
-        product = Product.objects.get(id=product_id)
-        product_size_colors = ProductSizeNColor.objects.filter(product=product, size__name=size)
-        
-        # Extract color names from the queryset
-        colors = [item.color.name for item in product_size_colors]
+        # Color names for the selected size and product ID, in one query
+        colors = list(ProductSizeNColor.objects.filter(product_id=product_id, size__name=size).values_list('color__name', flat=True))
         
         # Return the list of colors as a JSON response
         return JsonResponse({'colors': colors})
@@ -769,24 +790,36 @@ def updatecart(request):
     if 'user' not in request.session:
         return redirect('login')
     if request.method == 'POST':
+        cart_items = {str(item.id): item for item in Cart.objects.filter(uname=request.session.get('user'))}
+        changed = []
         for item in request.POST:
             if item.startswith('quantity_'):
                 cart_id = item.split('_')[1]
                 quantity = request.POST[item]
-                # {{ item.size }}
                 size_key = f'select-size_{cart_id}'
-                print(size_key)
                 cart_size = request.POST.get(size_key)
-                print(cart_size)
                 color_key = f'select-color_{cart_id}'
                 cart_color = request.POST.get(color_key)
 
-
-                cart_obj = Cart.objects.get(pk=cart_id)
-                cart_obj.quantity = quantity
+                cart_obj = cart_items.get(cart_id)
+                if cart_obj is None:
+                    continue
+                try:
+                    cart_obj.quantity = max(1, int(quantity))
+                except ValueError:
+                    continue
                 cart_obj.color = cart_color
                 cart_obj.size = cart_size
-                cart_obj.save()
+                changed.append(cart_obj)
+
+        # every changed line is checked against stock with one query
+        levels = stock_levels([cart_triple(item) for item in changed], exclude_user=request.session.get('user'))
+        for cart_obj in changed:
+            available = levels.get(cart_triple(cart_obj))
+            if available is not None and cart_obj.quantity > available:
+                cart_obj.quantity = max(available, 1)
+                messages.error(request, f'Only {available} of {cart_obj.size} / {cart_obj.color} available in stock.')
+        Cart.objects.bulk_update(changed, ['quantity', 'color', 'size'])
     return redirect('cart')
 
 
@@ -795,50 +828,41 @@ def checkout(request):
         return redirect('login')
 
     user_info = check_user(request)
-    user = User.objects.get(pk=user_info['user'].id)
-    cart_obj = Cart.objects.filter(uname=user)
-
-    currency_type = request.session.get('currency', '') or 'USD'
-
-    for item in cart_obj:
-        if 'USD' not in currency_type:
-            item.total_price = item.quantity * item.subproduct.product.price
-
-
-    currancy_cart(cart_obj, request.session.get('currency'))
-
+    if 'user' not in user_info:
+        return redirect('login')
+    user = user_info['user']
+    cart_obj = load_cart(user, request.session.get('currency'))
+    if cart_obj.unchosen:
+        # caught here, before any money is taken, rather than as a conflict after payment
+        for item in cart_obj.unchosen:
+            messages.error(request, f'Choose a size and color for {item.subproduct.product.name} before checking out.')
+        return redirect('cart')
+    # hold the cart's stock while the shopper pays
+    reserved = reserve_cart(user, cart_obj.lines)
     for item in cart_obj:
-        if not hasattr(item, 'total_price_usd'):
-            item.total_price_usd = None
-        if not hasattr(item, 'total_price'):
-            item.total_price = item.quantity * item.subproduct.product.price
-
-    total_cart_price = sum([item.total_price for item in cart_obj if item.total_price is not None])
-    total_cart_price_usd = sum([getattr(item, 'total_price_usd', None) or 0 for item in cart_obj if
-                                getattr(item, 'total_price_usd', None) is not None])
-
-    shipping_price = 50
-    shipping_price_usd = 1
-
-    after_shipping_price = total_cart_price + shipping_price
-    after_shipping_price_usd = total_cart_price_usd + shipping_price_usd
-    state = stateModel.objects.all()
+        if reserved.get(item.id, 0) < item.quantity:
+            messages.warning(request, f'Only {reserved.get(item.id, 0)} of {item.subproduct.product.name} ({item.size} / {item.color}) can be held for you right now.')
+    state = reference.states().rows
     user_address = AddressModel.objects.filter(user_id=user).first()
 
     context = {
-        'users': cart_obj,
+        'users': cart_obj.lines,
         **user_info,
         'state': state,
         'user_address': user_address,
-        'total_cart_price': total_cart_price,
-        'after_shipping_price': after_shipping_price,
+        'total_cart_price': cart_obj.total,
+        'after_shipping_price': cart_obj.grand_total,
         'number_of_items': len(cart_obj),
-        'total_cart_price_usd': total_cart_price_usd,
-        'after_shipping_price_usd': after_shipping_price_usd,
-        'shipping_price_usd': shipping_price_usd,
-        'shipping_price': shipping_price,
+        'total_cart_price_usd': cart_obj.total_display,
+        'after_shipping_price_usd': cart_obj.grand_total_display,
+        'shipping_price_usd': cart_obj.shipping_display,
+        'shipping_price': cart_obj.shipping,
+        # card/PayPal payments are always charged in USD, whatever currency is displayed
+        'paypal_total_usd': cart_obj.grand_total_usd,
         'stripe_public_key': settings.STRIPE_PUBLIC_KEY,
         'PAYPAL_CLIENT_ID': settings.PAYPAL_CLIENT_ID,
+        # sent back with the order so a retried submit replays the first result
+        'idempotency_key': uuid.uuid4().hex,
     }
 
     return render(request, 'checkout.html', context)
@@ -886,6 +910,7 @@ def address(request):
 
 
 
+@idempotent('place_order')
 def place_order(request):
     if 'user' not in request.session:
         return redirect('login')
@@ -895,49 +920,21 @@ def place_order(request):
         address_id  = AddressModel.objects.filter(user_id=user).first()
 
 
-        cart_obj = Cart.objects.filter(uname=user)
-        for item in cart_obj:
-            item.total_price = item.quantity * item.subproduct.product.price
-
-        total_cart_price = sum([item.total_price for item in cart_obj])
-        shipping_charge = 50
-        total_quantity = sum([item.quantity for item in cart_obj])
-        total_amount = total_cart_price + shipping_charge
-        order_date = datetime.date.today()
-        order_id = int(datetime.datetime.now().timestamp())
-        payment_mode = 'COD'
-
-        delivery_date = order_date + datetime.timedelta(days=7)
-        print(f'Delivery Date: {delivery_date}')
-        place_order_obj = placeOrder.objects.create(user_id=user, address_id=address_id, order_date=order_date, payment_mode=payment_mode, delivery_date=delivery_date, shipping_charge=shipping_charge, total_quantity=total_quantity, total_amount=total_amount, order_id=order_id)
-        place_order_obj.save()
-        # print(f'{address_id} - {total_cart_price}   - {total_quantity} -{product_id}  -  {shipping_charge} - {total_amount}  - {order_date} - {order_id}')
-       
-        for item in cart_obj:
-            size_color = item.subproduct.product_size_color.filter(size__name=item.size).first()    
-
-            if size_color:
-                purchased_quantity = min(item.quantity, size_color.stock_quantity)
-                print(f'Purchased Quantity: {purchased_quantity}')
-
-                if purchased_quantity > 0:
-                    sub_placeorder_obj = sub_placeorder.objects.create(
-                        order_id=place_order_obj,
-                        subproduct_id=item.subproduct,
-                        size=item.size,
-                        color=item.color,
-                        quantity=purchased_quantity,
-                        price=item.quantity * item.subproduct.product.price
-                    )
-
-                    sub_placeorder_obj.save()
-
-                    size_color.stock_quantity = F('stock_quantity') - purchased_quantity
-                    print(f'Stock Quantity: {size_color.stock_quantity}')
-
-                    size_color.save()
+        try:
+            place_order_obj = place_cart_order(user, address_id, payment_mode='COD',
+                                               payment={'method': 'cod', 'status': 'PENDING'})
+        except OrderConflict as e:
+            logger.info(f"Order not placed for user {user.id}: {e}")
+            messages.error(request, 'Some items in your cart changed while placing the order. Please review your cart and try again.')
+            return redirect('cart')
+        if place_order_obj is None:
+            messages.error(request, 'Your cart is empty.')
+            return redirect('cart')
+        request.idempotent_order = place_order_obj
+        order_id = place_order_obj.order_id
+        total_amount = place_order_obj.total_amount
+        order_date = place_order_obj.order_date
 
-            item.delete()
         subject = 'Order Confirmation'
         from_email = settings.DEFAULT_FROM_EMAIL
         to_email = [user.user_email]
@@ -947,6 +944,7 @@ def place_order(request):
             'total_amount': total_amount,
             'order_date': order_date,
             'items': sub_placeorder.objects.filter(order_id=place_order_obj)
+                     .select_related('subproduct_id__product', 'order_id__address_id__state'),
         }
 
         html_message = render_to_string('order_confirmation_email.html', context)
@@ -973,38 +971,14 @@ def place_order(request):
     return redirect('order_confirm', hasher_id=hasher_id)
 
 
-def currency_order(temp_, currency_type):
-    currency_converter = INRToUSDConverter(api_key='fca_live_YmDDOQ53V2ORAoTPnzY4M8vJOBhlmqbFi6NNmUBp')
-    # print('currency_type = ', currency_type)
-
-    try:
-        if not currency_type:
-            currency_type = ''
-
-            for order_obj in temp_:
-                order_obj.price_usd = currency_converter.convert_inr_to_usd(order_obj.price)
-                # print(order_obj.price_usd)
-                
-        else:
-            for order_obj in temp_:
-                order_obj.price_usd = order_obj.price
-                order_obj.total_price_usd = order_obj.order_id.total_amount
-
-
-    except Exception as e:
-        print(e)
-
-
-
-
 def order_confirm(request, hasher_id):
     if 'user' not in request.session:
         return redirect('login')
     else:
         order_id = decode_id(hasher_id)
         order = get_object_or_404(placeOrder, order_id=order_id)
-        order_obj = sub_placeorder.objects.filter(order_id=order)
-        currency_order(order_obj, request.session.get('currency'))
+        order_obj = sub_placeorder.objects.filter(order_id=order).select_related('order_id')
+        order_obj = currency(order_obj, request.session.get('currency'), kind='order')
         context = {'order': order_obj, 'order_id':'order_id'}
         return render(request, 'order_confirm.html', context)
 
@@ -1014,8 +988,9 @@ def order_history(request):
         return redirect('login')
     else:
         user_info = check_user(request)
-        user_id = request.session.get('user')
-        user = User.objects.get(pk=user_id)
+        if 'user' not in user_info:
+            return redirect('login')
+        user = user_info['user']
         
         order_obj1 = placeOrder.objects.filter(user_id=user)
         # print(order_obj1)
@@ -1024,43 +999,18 @@ def order_history(request):
         
         order_objs = []
         for order in order_obj1:
-            order_items = sub_placeorder.objects.filter(order_id=order)
+            order_items = sub_placeorder.objects.filter(order_id=order).select_related('order_id')
             order_objs.append({'order': order, 'items': order_items})
         # print(order_objs)
 
         order_objs.sort(key=lambda x: x['order'].order_date, reverse=True)
 
-        curency_history(order_objs, request.session.get('currency'))
+        currency([item for order in order_objs for item in order['items']], request.session.get('currency'), kind='order')
 
 
     context = {'orders': order_objs, **user_info}
     return render(request, 'order_history.html', context)
 
-def curency_history(temp_, currency_type):
-    currency_converter = INRToUSDConverter(api_key='fca_live_YmDDOQ53V2ORAoTPnzY4M8vJOBhlmqbFi6NNmUBp')
-    # print('currency_type = ', currency_type)
-    try:
-        if not currency_type:
-            currency_type = ''
-
-        if 'USD' in currency_type:
-            for order_obj in temp_:
-                for item in order_obj['items']:
-                    item.price_usd = currency_converter.convert_inr_to_usd(item.price)
-                    # print("cuurency",item.price_usd)
-
-                
-                    
-        else:
-            for order_obj in temp_:
-                for item in order_obj['items']:
-                    item.price_usd = item.price
-
-
-    except Exception as e:
-        print(e)
-
-
 def return_order(request, order_id):
     if 'user' not in request.session:
         return redirect('login')
@@ -1109,9 +1059,9 @@ def invoice(request, order_id):
     else:
         user = request.session.get('user')
         user = User.objects.get(pk=user)
-        order_obj = sub_placeorder.objects.filter(order_id=order_id)
+        order_obj = sub_placeorder.objects.filter(order_id=order_id).select_related('order_id')
         
-        currency_order(order_obj, request.session.get('currency'))
+        order_obj = currency(order_obj, request.session.get('currency'), kind='order')
         subtotal = sum([item.price for item in order_obj])
         shipping_charge = 50
         
@@ -0,0 +1,106 @@
+"""
+Buffered homepage visitor counter.
+
+Hits are added to in-process sharded counters (one lock per shard, so
+threads rarely wait on each other) and written to the single Visitor
+row with one atomic F() update every VISITOR_FLUSH_INTERVAL seconds or
+VISITOR_FLUSH_HITS hits. The displayed count is read from the cache.
+"""
+import atexit
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from .models import Visitor
+
+logger = logging.getLogger(__name__)
+
+VISITOR_ID = 1
+COUNT_CACHE_KEY = 'visitor_count'
+
+_shards = [[threading.Lock(), 0] for _ in range(settings.VISITOR_COUNTER_SHARDS)]
+# each thread gets its own shard round-robin (thread idents are aligned, so ident % n is always the same shard)
+_next_shard = itertools.count()
+_local = threading.local()
+_flush_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _pending():
+    return sum(shard[1] for shard in _shards)
+
+
+def _shard():
+    index = getattr(_local, 'shard', None)
+    if index is None:
+        index = _local.shard = next(_next_shard) % len(_shards)
+    return _shards[index]
+
+
+def record_visit():
+    shard = _shard()
+    with shard[0]:
+        shard[1] += 1
+
+    if time.monotonic() - _last_flush >= settings.VISITOR_FLUSH_INTERVAL or _pending() >= settings.VISITOR_FLUSH_HITS:
+        try:
+            flush_visits()
+        except Exception as e:
+            # e.g. "database is locked": the hits stay buffered for the next flush, the page still renders
+            logger.warning(f"Unable to flush visitor count: {e}")
+
+
+def flush_visits():
+    """Write the buffered hits with a single UPDATE, returns how many were written"""
+    global _last_flush
+    if not _flush_lock.acquire(blocking=False):
+        # another thread is already flushing
+        return 0
+    try:
+        hits = 0
+        for shard in _shards:
+            with shard[0]:
+                hits += shard[1]
+                shard[1] = 0
+        _last_flush = time.monotonic()
+        if not hits:
+            return 0
+
+        try:
+            if not Visitor.objects.filter(id=VISITOR_ID).update(count=F('count') + hits):
+                Visitor.objects.get_or_create(id=VISITOR_ID)
+                Visitor.objects.filter(id=VISITOR_ID).update(count=F('count') + hits)
+        except Exception:
+            # keep the hits for the next flush
+            shard = _shard()
+            with shard[0]:
+                shard[1] += hits
+            raise
+        cache.set(COUNT_CACHE_KEY, Visitor.objects.values_list('count', flat=True).get(id=VISITOR_ID), None)
+        return hits
+    finally:
+        _flush_lock.release()
+
+
+def visitor_count():
+    """Stored count from the cache plus this process' not yet flushed hits"""
+    count = cache.get(COUNT_CACHE_KEY)
+    if count is None:
+        count = Visitor.objects.filter(id=VISITOR_ID).values_list('count', flat=True).first() or 0
+        cache.set(COUNT_CACHE_KEY, count, None)
+    return count + _pending()
+
+
+def _flush_at_exit():
+    try:
+        flush_visits()
+    except Exception as e:
+        logger.warning(f"Unable to flush visitor count: {e}")
+
+
+atexit.register(_flush_at_exit)
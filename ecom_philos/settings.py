@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+import logging
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,6 +22,93 @@ STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', 'sk_test_51REPLACEME')
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID', 'your_sandbox_client_id_here')
 PAYPAL_SECRET = os.getenv('PAYPAL_SECRET', 'your_sandbox_secret_here')
 PAYPAL_MODE = "sandbox"  # Change to "live" later
+
+# Storefront currencies (code -> symbol). Prices are stored in BASE_CURRENCY, the rest are converted.
+BASE_CURRENCY = 'INR'
+CURRENCIES = {
+    'INR': 'Rs',
+    'USD': '$',
+    'EUR': '€',
+    'GBP': '£',
+}
+# flat shipping charge per currency, currencies not listed get the BASE_CURRENCY charge converted
+SHIPPING_CHARGES = {
+    'INR': 50,
+    'USD': 1,
+}
+
+# freecurrencyapi.com key and how long (seconds) a fetched rate table is served before a background refresh
+CURRENCY_API_KEY = os.getenv('CURRENCY_API_KEY', 'fca_live_YmDDOQ53V2ORAoTPnzY4M8vJOBhlmqbFi6NNmUBp')
+CURRENCY_RATE_TTL = int(os.getenv('CURRENCY_RATE_TTL', 60 * 60))
+# seconds per API call, total seconds per rate refresh (retries included)
+CURRENCY_API_TIMEOUT = 2
+CURRENCY_API_BUDGET = 5
+# seconds before the first retry of a failed rate fetch, doubled for every further retry and jittered
+CURRENCY_RETRY_BACKOFF = 0.5
+# open the circuit after this many consecutive failures, probe again after CURRENCY_BREAKER_RESET seconds
+CURRENCY_BREAKER_THRESHOLD = 3
+CURRENCY_BREAKER_RESET = 60
+
+# Homepage visitor counter: hits are buffered in memory and written every
+# VISITOR_FLUSH_INTERVAL seconds or VISITOR_FLUSH_HITS hits, whichever comes first
+VISITOR_COUNTER_SHARDS = 16
+VISITOR_FLUSH_INTERVAL = 10
+VISITOR_FLUSH_HITS = 500
+
+# 'default' is the cache shared by every web worker and management command: the bestseller ranking,
+# page and product caches and the invalidation version tokens rely on it. That needs Redis (REDIS_URL,
+# plus the redis package); without it each process gets its own LocMemCache, which is fine for a single
+# runserver but leaves every other process serving stale data after an edit.
+# 'local' is always per-process: data a process keeps for itself, such as when it last read a version token.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+    'local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'local'},
+}
+if os.getenv('REDIS_URL'):
+    CACHES['default'] = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': os.getenv('REDIS_URL')}
+else:
+    logging.getLogger(__name__).warning('REDIS_URL is not set: caches are per process, so workers and '
+                                        'management commands will not see each other\'s invalidations')
+
+# Homepage bestsellers: ranking window in days (None for all time) and how long a ranking is cached
+BESTSELLER_WINDOW_DAYS = 30
+BESTSELLER_CACHE_TTL = 15 * 60
+
+# Anonymous home/section/about/product pages are cached this many seconds;
+# any catalog or review change invalidates them immediately
+PAGE_CACHE_TTL = 10 * 60
+
+# Product page read model (sizes, colors, stock matrix) is cached this long; edits invalidate it
+PRODUCT_DETAIL_CACHE_TTL = 60 * 60
+
+# Price band edges for the category page price facet, in BASE_CURRENCY (converted for other currencies);
+# each band includes its lower edge and excludes its upper one
+PRICE_BANDS = [0, 500, 1100, 1600, 2100, 2600]
+
+# Size/Color/Category/state tables cached in each process are reloaded at least this often (seconds),
+# on top of the reload every save or delete triggers through the shared cache
+REFERENCE_TABLE_TTL = 5 * 60
+# How often (seconds) a process re-reads the shared version tokens of those tables
+REFERENCE_VERSION_CHECK = 5
+
+# How often (seconds) a process re-reads the shared version token of its search suggestion index
+SUGGEST_VERSION_CHECK = 5
+
+# Most variants one check_stock_batch request may ask about
+STOCK_BATCH_MAX = 200
+# How long (seconds) stock is held for a shopper after they open checkout
+STOCK_RESERVATION_TTL = 10 * 60
+# Responses of order/payment requests are replayed for retries carrying the same idempotency key this long (seconds)
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# How long (seconds) a retry waits for the original request to finish before answering 409
+IDEMPOTENCY_WAIT = 5
+# A key whose request has not answered after this many seconds is considered abandoned and can be reused
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# List pages (category, search and admin lists): rows per page and the largest ?per_page= allowed
+PAGE_SIZE = 24
+PAGE_SIZE_MAX = 100
+
 # from local_settings import *
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -95,6 +183,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.middleware.UserContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'app.middleware.OrderIdHashMiddleware'
@@ -111,11 +200,12 @@ TEMPLATES = [
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
-                # 'app.context_processors.currency_processor',
+                'app.context_processors.currency_processor',
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'app.page_cache.csrf_processor',
                 # 'social_django.context_processors.backends',
             ],
         },
@@ -35,6 +35,7 @@ urlpatterns = [
     path('get_available_colors/' ,get_available_colors , name='get_available_colors'),
     path('edit_product_sizencolor/' ,edit_product_sizencolor , name='edit_product_sizencolor'),
     path('check_stock_quantity/' ,check_stock_quantity , name='check_stock_quantity'),
+    path('check_stock_batch/', check_stock_batch, name='check_stock_batch'),
 
     path('admin_side/', admin_side, name='admin_side'),
     path('add_category/', add_category, name='add_category'),
@@ -62,6 +63,7 @@ urlpatterns = [
     path('get_conversation_ajax/<int:message_id>/', get_conversation_ajax, name='get_conversation_ajax'),
     path('mark_message_seen_ajax/<int:message_id>/', mark_message_seen_ajax, name='mark_message_seen_ajax'),
     path('get_unread_count/', get_unread_count, name='get_unread_count'),
+    path('currency_metrics/', currency_metrics, name='currency_metrics'),
     
     # User message URLs
     path('send_message/', send_message, name='send_message'),
@@ -95,6 +97,7 @@ urlpatterns = [
     path('contact/', contact, name='contact'),
     path('about/', about, name='about'),
     path('search/', search, name='search'),
+    path('search/suggest/', search_suggest, name='search_suggest'),
     path('cart/', cart, name='cart'),
     path('addcart/<int:id>', addcart, name='addcart'),
     path('get_colors/', get_colors , name='get_colors'),
@@ -108,8 +111,10 @@ urlpatterns = [
     path('cancel_order/<int:order_id>/', cancel_order, name='cancel_order'),
     path('return_order/<int:order_id>/', return_order, name='return_order'),
     path('show_product/<int:id>/', show_product, name='show_product'),
+    path('show_product/<int:id>/stock/', product_stock, name='product_stock'),
+    # payment endpoints live at the root, where checkout.html calls them, ahead of the catch-all section route
+    path('', include('src.payment.urls')),
     path('<str:cate>/' ,section , name='section'),
-    path('payment', include('src.payment.urls'))
 
 
 ]
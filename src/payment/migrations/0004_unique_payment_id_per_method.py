@@ -0,0 +1,37 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:14
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def mark_duplicate_payment_ids(apps, schema_editor):
+    """
+    Keep one Payment per (method, payment_id), preferring the one that
+    placed an order, then the oldest; the others get their id suffixed so
+    the unique constraint can be added without losing the trace.
+    """
+    Payment = apps.get_model('payment', 'Payment')
+    duplicated = (Payment.objects.exclude(payment_id__isnull=True).exclude(payment_id='')
+                  .values('method', 'payment_id').annotate(count=Count('id')).filter(count__gt=1))
+    for group in duplicated:
+        payments = (Payment.objects.filter(method=group['method'], payment_id=group['payment_id'])
+                    .order_by(models.F('placed_order').asc(nulls_last=True), 'id'))
+        for payment in payments[1:]:
+            suffix = f' (duplicate {payment.pk})'
+            payment.payment_id = payment.payment_id[:200 - len(suffix)] + suffix
+            payment.save(update_fields=['payment_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0003_payment_refund_due'),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_duplicate_payment_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_id__isnull', False), models.Q(('payment_id', ''), _negated=True)), fields=('method', 'payment_id'), name='unique_payment_id_per_method'),
+        ),
+    ]
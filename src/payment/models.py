@@ -1,9 +1,10 @@
 # payment/models.py
 import uuid
 
-from django.contrib.auth.models import User
 from django.db import models
 
+from app.models import User, placeOrder
+
 
 class Payment(models.Model):
     PAYMENT_METHODS = [
@@ -17,9 +18,11 @@ class Payment(models.Model):
         ('COMPLETED', 'Completed'),
         ('FAILED', 'Failed'),
         ('CANCELLED', 'Cancelled'),
+        ('REFUND_DUE', 'Paid, order not placed'),
     ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    placed_order = models.ForeignKey(placeOrder, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
     order_id = models.CharField(max_length=20, unique=True, blank=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='USD')
@@ -29,6 +32,13 @@ class Payment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            # a Stripe intent or PayPal order pays for at most one order
+            models.UniqueConstraint(fields=['method', 'payment_id'], name='unique_payment_id_per_method',
+                                    condition=models.Q(payment_id__isnull=False) & ~models.Q(payment_id='')),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.order_id:
             self.order_id = f"{uuid.uuid4().hex.upper()[:8]}"
@@ -2,6 +2,7 @@ import json
 import requests
 import base64
 import logging
+from decimal import ROUND_HALF_UP, Decimal
 
 import stripe
 from django.conf import settings
@@ -10,8 +11,11 @@ from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.utils import timezone
 
+from app.carts import load_cart
+from app.idempotency import idempotent, json_key
+from app.models import User, AddressModel
+from app.orders import OrderConflict, place_cart_order
 from .models import Payment
-from app.models import User, Cart, AddressModel, sub_placeorder, placeOrder
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -20,6 +24,43 @@ logger = logging.getLogger(__name__)
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
+def to_cents(amount):
+    """A USD Decimal as the integer number of cents Stripe works in"""
+    return int(amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) * 100)
+
+
+def record_unfulfilled(user, method, payment_id, amount, reason):
+    """
+    Keep a REFUND_DUE Payment for money that was taken without an order
+    being placed, so it can be traced and refunded. Written outside
+    place_cart_order, whose rollback would discard it.
+    """
+    payment, _ = Payment.objects.get_or_create(method=method, payment_id=payment_id, defaults={
+        'user': user,
+        'amount': amount,
+        'currency': 'USD',
+        'status': 'REFUND_DUE',
+        'completed_at': timezone.now(),
+    })
+    logger.error(f"{method} payment {payment_id} of {amount} USD taken but no order placed for user {user.id}: {reason}")
+    return payment
+
+
+def already_used(user, method, payment_id):
+    """
+    The response for a payment id that is already on a Payment, or None.
+    Each one finalizes at most one order, for as long as the Payment
+    exists: its own order is reported again, anything else is refused.
+    """
+    payment = Payment.objects.filter(method=method, payment_id=payment_id).select_related('placed_order').first()
+    if payment is None:
+        return None
+    if payment.user_id == user.id and payment.placed_order is not None:
+        return JsonResponse({'success': True, 'order_id': payment.placed_order.order_id})
+    logger.error(f"{method} payment {payment_id} already used by user {payment.user_id} ({payment.status}), not placing for user {user.id}")
+    return JsonResponse({'success': False, 'error': 'This payment has already been used. Please contact support.'})
+
+
 def get_paypal_access_token():
     """Get PayPal OAuth access token"""
     url = f"{settings.PAYPAL_API_BASE}/v1/oauth2/token"
@@ -91,14 +132,18 @@ def create_stripe_payment_intent(request):
 
     try:
         user = User.objects.get(pk=request.session['user'])
-        cart = Cart.objects.filter(uname=user)
+        cart = load_cart(user, 'USD')
 
-        if not cart.exists():
+        if not cart:
             return JsonResponse({'error': 'Cart is empty'}, status=400)
+        if cart.unchosen:
+            return JsonResponse({'error': 'Choose a size and color for every item in your cart'}, status=400)
 
         # Calculate total in cents
-        total_usd = sum((item.total_price_usd or item.quantity * 10) for item in cart) + 1
-        amount_cents = int(total_usd * 100)
+        total_usd = cart.grand_total_usd
+        if total_usd is None:
+            return JsonResponse({'error': 'USD exchange rate unavailable, please try again shortly'}, status=503)
+        amount_cents = to_cents(total_usd)
 
         # Create Payment Intent
         intent = stripe.PaymentIntent.create(
@@ -106,13 +151,13 @@ def create_stripe_payment_intent(request):
             currency='usd',
             metadata={
                 'user_id': user.id,
-                'user_email': user.email
+                'user_email': user.user_email
             }
         )
 
         return JsonResponse({
             'clientSecret': intent.client_secret,
-            'amount': total_usd
+            'amount': amount_cents
         })
 
     except Exception as e:
@@ -128,16 +173,20 @@ def create_paypal_order(request):
     try:
         data = json.loads(request.body)
         user = User.objects.get(pk=request.session['user'])
-        cart = Cart.objects.filter(uname=user)
+        cart = load_cart(user, 'USD')
 
-        if not cart.exists():
+        if not cart:
             return JsonResponse({'success': False, 'error': 'Cart is empty'})
+        if cart.unchosen:
+            return JsonResponse({'success': False, 'error': 'Choose a size and color for every item in your cart'})
 
-        total_usd = sum((item.total_price_usd or item.quantity * 10) for item in cart) + 1
+        total_usd = cart.grand_total_usd
+        if total_usd is None:
+            return JsonResponse({'success': False, 'error': 'USD exchange rate unavailable, please try again shortly'})
 
         request.session['pending_order'] = {
             'user_id': user.id,
-            'total_usd': round(total_usd, 2),
+            'total_usd': float(total_usd),
             'method': 'paypal',
             'payment_id': data.get('orderID', '')
         }
@@ -151,6 +200,7 @@ def create_paypal_order(request):
         return JsonResponse({'success': False, 'error': str(e)})
 
 
+@idempotent('paypal', json_key('orderID'))
 def capture_paypal_order(request):
     """Capture and verify PayPal payment, then create order"""
     if request.method != 'POST':
@@ -171,6 +221,10 @@ def capture_paypal_order(request):
             logger.error("User not in session")
             return JsonResponse({'success': False, 'error': 'User not logged in'})
 
+        used = already_used(User.objects.get(pk=request.session['user']), 'paypal', order_id)
+        if used is not None:
+            return used
+
         # Verify PayPal order on server side
         paypal_order = verify_paypal_order(order_id)
 
@@ -198,13 +252,8 @@ def capture_paypal_order(request):
             logger.error("No pending order in session")
             return JsonResponse({'success': False, 'error': 'Session expired. Please try again.'})
 
-        # Get user and cart
+        # Get user
         user = User.objects.get(pk=payment_data['user_id'])
-        cart_items = Cart.objects.filter(uname=user)
-
-        if not cart_items.exists():
-            logger.error("Cart is empty")
-            return JsonResponse({'success': False, 'error': 'Cart is empty'})
 
         # Get user address
         user_address = AddressModel.objects.filter(user_id=user).first()
@@ -212,58 +261,38 @@ def capture_paypal_order(request):
             logger.error("No address found for user")
             return JsonResponse({'success': False, 'error': 'Please add a delivery address first'})
 
-        # Verify payment amount matches
-        paypal_amount = float(paypal_order.get('purchase_units', [{}])[0].get('amount', {}).get('value', 0))
-        expected_amount = float(payment_data['total_usd'])
+        # Verify the payment covers the cart as it is now: lines may have been added since the PayPal order was created
+        paypal_amount = Decimal(str(paypal_order.get('purchase_units', [{}])[0].get('amount', {}).get('value', 0)))
+        cart = load_cart(user, 'USD')
+        if not cart:
+            return JsonResponse({'success': False, 'error': 'Cart is empty'})
+        if cart.grand_total_usd is None:
+            return JsonResponse({'success': False, 'error': 'USD exchange rate unavailable, please try again shortly'})
 
-        logger.info(f"Amount verification - PayPal: {paypal_amount}, Expected: {expected_amount}")
+        logger.info(f"Amount verification - PayPal: {paypal_amount}, Cart: {cart.grand_total_usd}")
 
-        if abs(paypal_amount - expected_amount) > 0.01:  # Allow 1 cent difference for rounding
-            logger.error(f"Amount mismatch - PayPal: {paypal_amount}, Expected: {expected_amount}")
+        if to_cents(paypal_amount) != to_cents(cart.grand_total_usd):
+            record_unfulfilled(user, 'paypal', order_id, paypal_amount,
+                               f"amount does not match the cart total of {cart.grand_total_usd}")
             return JsonResponse({
                 'success': False,
                 'error': 'Payment amount mismatch. Please contact support.'
             })
 
-        # Create order
+        # Create order, order items and payment record, then clear the cart
         logger.info("Creating order in database...")
-        order = placeOrder.objects.create(
-            user_id=user,
-            address_id=user_address,
-            order_date=timezone.now().date(),
-            payment_mode='PAYPAL',
-            total_amount=payment_data['total_usd'],
-            shipping_charge=1,
-            total_quantity=sum(i.quantity for i in cart_items),
-            order_status='Paid'
-        )
-        logger.info(f"Order created: {order.order_id}")
-
-        # Save order items
-        for item in cart_items:
-            sub_placeorder.objects.create(
-                order_id=order,
-                subproduct_id=item.subproduct,
-                quantity=item.quantity,
-                price=item.total_price_usd or item.quantity * 10,
-                size=item.size,
-                color=item.color
-            )
-
-        # Clear cart
-        cart_items.delete()
-        logger.info("Cart cleared")
-
-        # Save payment record
-        Payment.objects.create(
-            user=user,
-            amount=payment_data['total_usd'],
-            method='paypal',
-            payment_id=order_id,
-            status='COMPLETED',
-            completed_at=timezone.now()
-        )
-        logger.info("Payment record saved")
+        order = place_cart_order(user, user_address, payment_mode='PAYPAL', order_status='Paid', allow_partial=False, payment={
+            'method': 'paypal',
+            'payment_id': order_id,
+            'status': 'COMPLETED',
+            'amount': paypal_amount,
+            'currency': 'USD',
+            'completed_at': timezone.now(),
+        })
+        if order is None:
+            logger.error("Cart is empty")
+            return JsonResponse({'success': False, 'error': 'Cart is empty'})
+        request.idempotent_order = order
 
         # Clear session
         request.session.pop('pending_order', None)
@@ -275,6 +304,9 @@ def capture_paypal_order(request):
             'order_id': order.order_id
         })
 
+    except OrderConflict as e:
+        record_unfulfilled(user, 'paypal', order_id, paypal_amount, e)
+        return JsonResponse({'success': False, 'error': 'Some items are no longer in stock. Please contact support for a refund.'})
     except User.DoesNotExist:
         logger.error("User not found")
         return JsonResponse({'success': False, 'error': 'User not found'})
@@ -283,6 +315,7 @@ def capture_paypal_order(request):
         return JsonResponse({'success': False, 'error': f'Server error: {str(e)}'})
 
 
+@idempotent('stripe', json_key('payment_intent_id'))
 def payment_success_stripe(request):
     """Handle Stripe payment success"""
     if request.method != 'POST':
@@ -296,64 +329,62 @@ def payment_success_stripe(request):
             return JsonResponse({'success': False, 'error': 'No payment intent ID'})
 
         user = User.objects.get(pk=request.session['user'])
-        cart_items = Cart.objects.filter(uname=user)
-
-        if not cart_items.exists():
-            return JsonResponse({'success': False, 'error': 'Cart is empty'})
-
-        total_usd = sum((item.total_price_usd or item.quantity * 10) for item in cart_items) + 1
+        used = already_used(user, 'stripe', payment_intent_id)
+        if used is not None:
+            return used
+
+        # Verify the payment with Stripe rather than trusting the browser
+        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        if intent.status != 'succeeded':
+            return JsonResponse({'success': False, 'error': f'Payment not completed. Status: {intent.status}'})
+        if str(intent.metadata.get('user_id')) != str(user.id):
+            logger.error(f"Stripe payment {payment_intent_id} was made for user {intent.metadata.get('user_id')}, not {user.id}")
+            return JsonResponse({'success': False, 'error': 'This payment does not belong to your account'})
+        amount = Decimal(intent.amount) / 100
 
         # Get user address
         user_address = AddressModel.objects.filter(user_id=user).first()
         if not user_address:
             return JsonResponse({'success': False, 'error': 'Please add a delivery address first'})
 
-        # Create order
-        order = placeOrder.objects.create(
-            user_id=user,
-            address_id=user_address,
-            order_date=timezone.now().date(),
-            payment_mode='STRIPE',
-            total_amount=total_usd,
-            shipping_charge=1,
-            total_quantity=sum(i.quantity for i in cart_items),
-            order_status='Paid'
-        )
-
-        # Save order items
-        for item in cart_items:
-            sub_placeorder.objects.create(
-                order_id=order,
-                subproduct_id=item.subproduct,
-                quantity=item.quantity,
-                price=item.total_price_usd or item.quantity * 10,
-                size=item.size,
-                color=item.color
-            )
-
-        # Clear cart
-        cart_items.delete()
-
-        # Save payment
-        Payment.objects.create(
-            user=user,
-            amount=total_usd,
-            method='stripe',
-            payment_id=payment_intent_id,
-            status='COMPLETED',
-            completed_at=timezone.now()
-        )
+        # The intent was created for the cart total; the cart may have changed since
+        cart = load_cart(user, 'USD')
+        if not cart:
+            return JsonResponse({'success': False, 'error': 'Cart is empty'})
+        if cart.grand_total_usd is None:
+            return JsonResponse({'success': False, 'error': 'USD exchange rate unavailable, please try again shortly'})
+        if intent.amount != to_cents(cart.grand_total_usd):
+            record_unfulfilled(user, 'stripe', payment_intent_id, amount,
+                               f"amount does not match the cart total of {cart.grand_total_usd}")
+            return JsonResponse({'success': False, 'error': 'Payment amount mismatch. Please contact support.'})
+
+        # Create order, order items and payment record, then clear the cart
+        order = place_cart_order(user, user_address, payment_mode='STRIPE', order_status='Paid', allow_partial=False, payment={
+            'method': 'stripe',
+            'payment_id': payment_intent_id,
+            'status': 'COMPLETED',
+            'amount': amount,
+            'currency': 'USD',
+            'completed_at': timezone.now(),
+        })
+        if order is None:
+            return JsonResponse({'success': False, 'error': 'Cart is empty'})
+        request.idempotent_order = order
 
         return JsonResponse({
             'success': True,
             'order_id': order.order_id
         })
 
+    except OrderConflict as e:
+        record_unfulfilled(user, 'stripe', payment_intent_id, amount, e)
+        return JsonResponse({'success': False, 'error': 'Some items are no longer in stock. Please contact support for a refund.'})
     except Exception as e:
         logger.error(f"Stripe success error: {str(e)}", exc_info=True)
         return JsonResponse({'success': False, 'error': str(e)})
 
 
+@idempotent('cod')
 def payment_success_cod(request):
     """Handle Cash on Delivery"""
     if 'user' not in request.session:
@@ -361,13 +392,6 @@ def payment_success_cod(request):
 
     try:
         user = User.objects.get(pk=request.session['user'])
-        cart_items = Cart.objects.filter(uname=user)
-
-        if not cart_items.exists():
-            messages.error(request, "Your cart is empty")
-            return redirect('cart')
-
-        total_usd = sum((item.total_price_usd or item.quantity * 10) for item in cart_items) + 1
 
         # Get user address
         user_address = AddressModel.objects.filter(user_id=user).first()
@@ -375,43 +399,19 @@ def payment_success_cod(request):
             messages.error(request, "Please add a delivery address")
             return redirect('checkout')
 
-        # Create order
-        order = placeOrder.objects.create(
-            user_id=user,
-            address_id=user_address,
-            order_date=timezone.now().date(),
-            payment_mode='COD',
-            total_amount=total_usd,
-            shipping_charge=1,
-            total_quantity=sum(i.quantity for i in cart_items),
-            order_status='Pending'
-        )
-
-        # Save order items
-        for item in cart_items:
-            sub_placeorder.objects.create(
-                order_id=order,
-                subproduct_id=item.subproduct,
-                quantity=item.quantity,
-                price=item.total_price_usd or item.quantity * 10,
-                size=item.size,
-                color=item.color
-            )
-
-        # Clear cart
-        cart_items.delete()
-
-        # Save payment
-        Payment.objects.create(
-            user=user,
-            amount=total_usd,
-            method='cod',
-            status='PENDING'
-        )
+        # Create order, order items and payment record, then clear the cart
+        order = place_cart_order(user, user_address, payment_mode='COD', payment={'method': 'cod', 'status': 'PENDING'})
+        if order is None:
+            messages.error(request, "Your cart is empty")
+            return redirect('cart')
+        request.idempotent_order = order
 
         messages.success(request, f"Order {order.order_id} placed successfully!")
         return redirect('order_history')
 
+    except OrderConflict:
+        messages.error(request, "Some items in your cart changed while placing the order. Please review your cart and try again.")
+        return redirect('cart')
     except Exception as e:
         logger.error(f"COD error: {str(e)}", exc_info=True)
         messages.error(request, f"Error: {str(e)}")